@@ -2,15 +2,59 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import collections
+import functools
+import gzip
 import logging
 import mimetypes
 import os
+import time
 
+from email.utils import formatdate, parsedate_to_datetime
 from http import HTTPStatus
-from httpserver import HttpServer, HttpError, send_response
-from multiprocessing_logging import install_mp_handler
+from httpserver import HttpServer, HttpError, send_response, encode_headers
 from urllib.parse import unquote
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Сколько файлов держит кэш каждого процесса.
+FILE_CACHE_SIZE = 256
+# Файлы не больше этого размера кэш хранит в памяти целиком,
+# для остальных держит открытый файл.
+SMALL_FILE_SIZE = 64 * 1024
+# Не чаще, чем раз в столько секунд, кэш проверяет, что файл
+# на диске не изменился.
+FILE_CACHE_CHECK = 1.0
+
+# Сжимаем текстовые файлы не меньше MIN_COMPRESS_SIZE и не больше
+# MAX_COMPRESS_SIZE байт. Сжатые варианты хранятся в кэше размером
+# не больше COMPRESS_CACHE_SIZE байт.
+COMPRESS_TYPES = {
+    "application/javascript", "application/json", "application/xml",
+    "image/svg+xml"
+}
+MIN_COMPRESS_SIZE = 256
+MAX_COMPRESS_SIZE = 8 * 1024 * 1024
+COMPRESS_CACHE_SIZE = 64 * 1024 * 1024
+# Сколько файлов, которые сжатие не уменьшает, помнить, чтобы не
+# сжимать их снова.
+INCOMPRESSIBLE_CACHE_SIZE = 1024
+
+# Способы сжатия в порядке предпочтения и расширения заранее сжатых
+# копий файлов. Файл сжимается прямо в цикле событий и держит все
+# подключения процесса, поэтому степень сжатия умеренная: максимальная
+# для brotli сжимает файл в 8 МБ несколько секунд. Для лучшего сжатия
+# положите рядом заранее сжатую копию.
+COMPRESSORS = collections.OrderedDict()
+if brotli:
+    COMPRESSORS["br"] = functools.partial(brotli.compress, quality=5)
+COMPRESSORS["gzip"] = functools.partial(gzip.compress, compresslevel=6)
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}
+
 
 def strip_uri_path(uri):
     """ Вырезаем и возвращаем путь из URI. """
@@ -40,10 +84,287 @@ def get_path(doc_root, uri):
     return path
 
 
+class CachedFile(object):
+    """ Открытый файл из doc_root и все, что нужно для ответа:
+        размер, MIME-тип и заголовки. Маленький файл хранится в
+        памяти целиком, большой - как открытый файл для sendfile.
+    """
+
+    def __init__(self, path):
+        (_, ext) = os.path.splitext(path)
+        self.path = path
+        self.mime_type = mimetypes.types_map[ext]
+
+        try:
+            self.file = open(path, 'rb')
+        except Exception:
+            raise HttpError(HTTPStatus.FORBIDDEN)
+
+        st = os.fstat(self.file.fileno())
+        self.version = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.size = st.st_size
+        self.content = None
+        if self.size <= SMALL_FILE_SIZE:
+            with self.file:
+                self.content = self.file.read()
+            self.file = None
+
+        self.compressible = (
+            (self.mime_type.startswith("text/") or self.mime_type in COMPRESS_TYPES)
+            and MIN_COMPRESS_SIZE <= self.size <= MAX_COMPRESS_SIZE
+        )
+
+        self.mtime = int(st.st_mtime)
+        self.etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.validators = {
+            "ETag": self.etag,
+            "Last-Modified": self.last_modified
+        }
+        self.headers = dict(
+            self.validators,
+            **{
+                "Content-Type": self.mime_type,
+                "Content-Length": self.size,
+                "Accept-Ranges": "bytes"
+            }
+        )
+        if self.compressible:
+            # Ответ зависит от Accept-Encoding, о чем нужно сказать
+            # кэширующим прокси.
+            self.headers["Vary"] = "Accept-Encoding"
+            self.validators["Vary"] = "Accept-Encoding"
+        # Заголовки ответов 200 и 304 кодируем один раз.
+        self.header_block = encode_headers(self.headers)
+        self.validators_block = encode_headers(self.validators)
+        self.checked = time.monotonic()
+
+    def changed(self):
+        """ Проверяем, что файл на диске тот же, что мы открыли. """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_ino, st.st_size, st.st_mtime_ns) != self.version
+
+    def read(self):
+        if self.content is not None:
+            return self.content
+        return os.pread(self.file.fileno(), self.size, 0)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class FileCache(object):
+    """ LRU-кэш открытых файлов. По одному URI кэш отдает CachedFile,
+        не проверяя путь и не открывая файл заново. Изменение файла
+        на диске замечается по stat не позже, чем через check_interval
+        секунд.
+    """
+
+    def __init__(self, size=FILE_CACHE_SIZE, check_interval=FILE_CACHE_CHECK):
+        self.size = size
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+
+    def get(self, doc_root, uri):
+        key = (doc_root, uri)
+        entry = self.entries.get(key)
+        if entry:
+            now = time.monotonic()
+            if now - entry.checked < self.check_interval or not entry.changed():
+                entry.checked = now
+                self.entries.move_to_end(key)
+                return entry
+            del self.entries[key]
+            entry.close()
+
+        path = get_path(doc_root, uri)
+        if not path:
+            raise HttpError(HTTPStatus.NOT_FOUND)
+
+        logging.info(f'Requested {path}')
+        entry = CachedFile(path)
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            _, old_entry = self.entries.popitem(last=False)
+            old_entry.close()
+        return entry
+
+
+CompressedVariant = collections.namedtuple(
+    "CompressedVariant", ["content", "headers", "etag", "validators"]
+)
+
+
+class CompressedCache(object):
+    """ LRU-кэш сжатых вариантов файлов. Ключ - путь, версия файла и
+        способ сжатия, поэтому измененный файл сжимается заново, а
+        старые варианты постепенно вытесняются. Если рядом с файлом
+        лежит не более старая сжатая копия (index.html.gz), берем ее
+        вместо сжатия. Файлы, которые сжатие не уменьшает, запоминаются
+        в отдельном LRU-множестве ограниченного размера.
+    """
+
+    def __init__(self, size=COMPRESS_CACHE_SIZE,
+                 incompressible_size=INCOMPRESSIBLE_CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self.entries = collections.OrderedDict()
+        self.incompressible_size = incompressible_size
+        self.incompressible = collections.OrderedDict()
+
+    def get(self, entry, encoding):
+        """ Возвращаем сжатое содержимое файла и закодированные
+            заголовки ответа или None, если сжатие не уменьшает файл.
+        """
+        key = (entry.path, entry.version, encoding)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if key in self.incompressible:
+            self.incompressible.move_to_end(key)
+            return None
+
+        content = self.load(entry, encoding)
+        if len(content) >= entry.size:
+            self.incompressible[key] = None
+            if len(self.incompressible) > self.incompressible_size:
+                self.incompressible.popitem(last=False)
+            return None
+
+        etag = f'{entry.etag[:-1]}-{encoding}"'
+        validators = dict(entry.validators, ETag=etag)
+        headers = dict(
+            entry.headers,
+            **{
+                "ETag": etag,
+                "Content-Length": len(content),
+                "Content-Encoding": encoding
+            }
+        )
+        del headers["Accept-Ranges"]
+        variant = CompressedVariant(content, encode_headers(headers), etag,
+                                    encode_headers(validators))
+
+        self.entries[key] = variant
+        self.used += len(content)
+        while self.used > self.size:
+            _, old_variant = self.entries.popitem(last=False)
+            self.used -= len(old_variant.content)
+        return variant
+
+    def load(self, entry, encoding):
+        path = entry.path + PRECOMPRESSED[encoding]
+        try:
+            st = os.stat(path)
+            if st.st_mtime_ns >= entry.version[2] and st.st_size <= MAX_COMPRESS_SIZE:
+                with open(path, 'rb') as file:
+                    logging.info(f'Use precompressed {path}')
+                    return file.read()
+        except OSError:
+            pass
+
+        return COMPRESSORS[encoding](entry.read())
+
+
+file_cache = FileCache()
+compressed_cache = CompressedCache()
+
+
+def accept_encoding(headers):
+    """ Выбираем способ сжатия из тех, что клиент перечислил в
+        Accept-Encoding с ненулевым q. Возвращаем None, если
+        сжимать нельзя.
+    """
+    accepted = {}
+    for item in headers.get("Accept-Encoding", "").split(','):
+        name, _, params = item.partition(';')
+        params = params.strip()
+        quality = 1.0
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in COMPRESSORS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def not_modified(entry, headers, etag):
+    """ Проверяем условный запрос: есть ли у клиента актуальная копия
+        файла с ETag etag. If-None-Match важнее If-Modified-Since.
+    """
+    if "If-None-Match" in headers:
+        etags = [value.strip() for value in headers["If-None-Match"].split(',')]
+        return "*" in etags or any(
+            value.startswith('W/') and value[2:] == etag or value == etag
+            for value in etags
+        )
+
+    if "If-Modified-Since" in headers:
+        try:
+            since = parsedate_to_datetime(headers["If-Modified-Since"])
+        except (TypeError, ValueError):
+            return False
+        return entry.mtime <= since.timestamp()
+
+    return False
+
+
+def parse_range(headers, entry):
+    """ Разбираем заголовок Range и возвращаем запрошенный диапазон
+        байт как (start, end) включительно. Возвращаем None, если
+        нужно отдать файл целиком: диапазона нет, он задан с ошибкой,
+        запрошено несколько диапазонов или If-Range не совпал с
+        текущей версией файла.
+    """
+    value = headers.get("Range")
+    if not value or not value.startswith("bytes="):
+        return None
+    if headers.get("If-Range", entry.etag) not in (entry.etag, entry.last_modified):
+        return None
+
+    spec = value[len("bytes="):].strip()
+    if ',' in spec:
+        return None
+    start, sep, end = spec.partition('-')
+    if not sep:
+        return None
+
+    try:
+        if start:
+            start = int(start)
+            if not end:
+                end = entry.size - 1
+            elif int(end) < start:
+                return None
+            else:
+                end = int(end)
+        else:
+            # bytes=-N - последние N байт файла.
+            start = max(entry.size - int(end), 0)
+            end = entry.size - 1
+    except ValueError:
+        return None
+
+    if start >= entry.size:
+        raise HttpError(
+            HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+            {"Content-Range": f"bytes */{entry.size}"}
+        )
+    return (start, min(end, entry.size - 1))
+
+
 def handle_request(socket, method, uri, headers, doc_root):
     """ Обрабатываем GET и HEAD запросы. Находим запрошенный
-        файл на диске, считываем его содержимое или размер,
-        формируем и отправляем ответ.
+        файл на диске, формируем и отправляем ответ.
     """
 
     uri = strip_uri_path(uri)
@@ -52,36 +373,63 @@ def handle_request(socket, method, uri, headers, doc_root):
         raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED)
 
     logging.info(f'Handle {method} {uri}')
-    path = get_path(doc_root, uri)
-    if not path:
-        raise HttpError(HTTPStatus.NOT_FOUND)
+    entry = file_cache.get(doc_root, uri)
 
-    logging.info(f'Requested {path}')
+    # Сначала выбираем вариант файла, который отправим, и проверяем
+    # ETag именно этого варианта. Диапазоны отдаем только из
+    # несжатого файла.
+    variant = None
+    if entry.compressible and "Range" not in headers:
+        encoding = accept_encoding(headers)
+        if encoding:
+            variant = compressed_cache.get(entry, encoding)
 
-    (_, ext) = os.path.splitext(path)
-    mime_type = mimetypes.types_map[ext]
-
-    content = None
-    content_len = 0
-    if method == "GET":
-        try:
-            with open(path, 'rb') as file:
-                content = file.read()
-            content_len = len(content)
-        except Exception:
-            raise HttpError(HTTPStatus.FORBIDDEN)
+    if variant:
+        etag, validators = variant.etag, variant.validators
     else:
-        try:
-            content_len = os.path.getsize(path)
-        except Exception:
-            raise HttpError(HTTPStatus.FORBIDDEN)
+        etag, validators = entry.etag, entry.validators_block
+    if not_modified(entry, headers, etag):
+        send_response(socket, HTTPStatus.NOT_MODIFIED, validators)
+        return
 
-    send_response(
-        socket,
-        HTTPStatus.OK,
-        {"Content-Type": mime_type, "Content-Length": content_len},
-        content
-    )
+    if variant:
+        send_response(
+            socket,
+            HTTPStatus.OK,
+            variant.headers,
+            variant.content if method == "GET" else None
+        )
+        return
+
+    status = HTTPStatus.OK
+    response_headers = entry.header_block
+    start, count = 0, entry.size
+    byte_range = parse_range(headers, entry) if method == "GET" else None
+    if byte_range:
+        status = HTTPStatus.PARTIAL_CONTENT
+        start, end = byte_range
+        count = end - start + 1
+        response_headers = dict(
+            entry.headers,
+            **{
+                "Content-Length": count,
+                "Content-Range": f"bytes {start}-{end}/{entry.size}"
+            }
+        )
+
+    if method == "HEAD" or entry.content is not None:
+        send_response(
+            socket,
+            status,
+            response_headers,
+            entry.content[start:start + count] if method == "GET" else None
+        )
+        return
+
+    # Тело большого файла отправляем через sendfile: данные идут
+    # из файла в сокет без копирования в память процесса.
+    send_response(socket, status, response_headers)
+    socket.sendfile(entry.file, start, count)
 
 
 if __name__ == '__main__':
@@ -91,6 +439,9 @@ if __name__ == '__main__':
                             type=int, default=5)
     arg_parser.add_argument('-p', '--port', help='port number',
                             type=int, default=80)
+    arg_parser.add_argument('-e', '--engine', help='connection handling engine',
+                            default='pool',
+                            choices=['pool', 'prefork', 'event', 'asyncio'])
     arg_parser.add_argument("-l", "--log-level", help="Set the logging level",
                             default='INFO',
                             choices=[
@@ -106,6 +457,8 @@ if __name__ == '__main__':
 
     log_level = getattr(logging, args.log_level)
     logging.basicConfig(level=getattr(logging, args.log_level))
+    # Нужен только для запуска сервера, тесты обходятся без него.
+    from multiprocessing_logging import install_mp_handler
     install_mp_handler()
 
     mimetypes.init()
@@ -113,7 +466,7 @@ if __name__ == '__main__':
     server = HttpServer(
         '127.0.0.1', args.port,
         doc_root, args.workers, log_level,
-        handle_request
+        handle_request, args.engine
     )
     try:
         server.start()
@@ -1,21 +1,147 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import collections
+import errno
+import functools
 import logging
 import os
+import selectors
 import signal
 import socket
+import stat
+import time
 
-from datetime import datetime
 from email.utils import formatdate
 from http import HTTPStatus
-from multiprocessing import Pool
-from time import mktime
+from multiprocessing import Array, Pool, Process
+from multiprocessing.connection import wait
+
+
+# Сколько байт читать из сокета за раз.
+RECV_SIZE = 65536
+# Максимальный размер строки запроса вместе с заголовками.
+MAX_HEADERS_SIZE = 64 * 1024
+# Сколько секунд ждать данных от клиента. В событийном движке столько
+# же живет постоянное подключение без запросов.
+READ_TIMEOUT = 10
+# Сколько ответов на конвейерные запросы копить в выходном буфере,
+# прежде чем дождаться, пока клиент их прочитает.
+PIPELINE_LIMIT = 64
+# Сколько буферов отправлять одним вызовом sendmsg.
+IOV_MAX = 64
+
+# На сколько секунд событийный движок перестает принимать подключения,
+# если у процесса или системы кончились файловые дескрипторы.
+ACCEPT_PAUSE = 1
+
+# Каким куском читать файл, если os.sendfile для него не работает.
+SENDFILE_CHUNK = 65536
+
+# Как часто, в секундах, главный процесс пишет в лог, сколько запросов
+# обработал каждый процесс.
+STATS_INTERVAL = 60
+# Если процесс упал быстрее, чем за столько секунд, перед перезапуском
+# ждем столько же, чтобы не перезапускать его в цикле.
+RESTART_DELAY = 1
 
 
 class HttpError(Exception):
-    def __init__(self, httpStatus):
+    def __init__(self, httpStatus, headers=None):
         self.httpStatus = httpStatus
+        self.headers = headers
+
+
+# Общий буфер для recv_into. Процессы сервера однопоточные, поэтому
+# одного буфера на процесс достаточно.
+recv_buffer = bytearray(RECV_SIZE)
+
+
+class RequestReader(object):
+    """ Входной буфер подключения. Данные из сокета читаются через
+        recv_into и копятся в bytearray. Конец заголовков ищется только
+        в новых данных, размер заголовков ограничен max_size. Все, что
+        пришло после заголовков, остается в буфере: это тело запроса,
+        которое мы пропускаем, или следующие запросы на постоянном
+        подключении.
+    """
+
+    def __init__(self, socket=None, max_size=MAX_HEADERS_SIZE):
+        self.socket = socket
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.skip = 0
+
+    def receive(self, socket):
+        """ Читаем, что пришло в сокет. Возвращаем число байт,
+            0 - если клиент закрыл подключение.
+        """
+        view = memoryview(recv_buffer)
+        size = socket.recv_into(view)
+        self.buffer += view[:size]
+        return size
+
+    def skip_body(self, headers):
+        """ Пропускаем тело запроса длиной Content-Length. """
+        try:
+            length = int(headers.get("Content-Length", 0))
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        if length < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        self.skip = length
+
+    def next_request(self):
+        """ Возвращаем requets-line и заголовки следующего запроса из
+            буфера или None, если запрос пришел не целиком.
+        """
+        if self.skip:
+            skipped = min(self.skip, len(self.buffer))
+            del self.buffer[:skipped]
+            self.skip -= skipped
+            if self.skip:
+                return None
+
+        # Пустые строки перед запросом пропускаем.
+        while self.buffer.startswith(b'\r\n'):
+            del self.buffer[:2]
+
+        # Ищем пустую строку, которая завершает заголовки, только
+        # в новых данных. Три байта с прошлого поиска захватываем на
+        # случай, если \r\n\r\n разбит между пакетами.
+        delim_pos = self.buffer.find(b'\r\n\r\n', max(self.scanned - 3, 0))
+        if delim_pos == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.max_size:
+                raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            return None
+        if delim_pos > self.max_size:
+            raise HttpError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        headers_list = bytes(self.buffer[:delim_pos]).split(b'\r\n')
+        del self.buffer[:delim_pos + 4]
+        self.scanned = 0
+        return (headers_list[0], headers_list[1:])
+
+    def read_request(self):
+        """ Читаем из блокирующего сокета, пока не придет запрос
+            целиком. Возвращаем None, если клиент закрыл подключение,
+            не начав новый запрос.
+        """
+        while True:
+            request = self.next_request()
+            if request:
+                return request
+            try:
+                size = self.receive(self.socket)
+            except socket.timeout:
+                raise HttpError(HTTPStatus.REQUEST_TIMEOUT)
+            if not size:
+                if self.buffer:
+                    raise HttpError(HTTPStatus.BAD_REQUEST)
+                return None
 
 
 def read_request(socket):
@@ -23,30 +149,11 @@ def read_request(socket):
         * requets-line
         * message-header - как массив строк
     """
-    data = b''
-    headers_list = []
-    while True:
-        buf = socket.recv(1024)
-        if not buf:
-            break
-
-        data += buf
-
-        # Считываем данные из сокета, пока не обнаружим
-        # пустую строку. Все, что до нее, это заголовки.
-        # После нее - опциональные данные запроса.
-        delim_pos = data.find(b'\r\n\r\n')
-        if delim_pos != -1:
-            headers_list = data[:delim_pos].split(b'\r\n')
-            break
-
-    if not headers_list:
+    request = RequestReader(socket).read_request()
+    if not request:
         raise HttpError(HTTPStatus.BAD_REQUEST)
 
-    return (
-        headers_list[0],
-        headers_list[1:]
-    )
+    return request
 
 
 def parse_request(request_line, headers_list):
@@ -65,44 +172,505 @@ def parse_request(request_line, headers_list):
     uri = params[1].decode('utf-8')
 
     # Превращаем список строк с заголовками в словарь:
-    # заголовок -> значение.
-    headers = dict(
-        map(
-            lambda x: x.strip(),
-            x.decode('utf-8').split(':')
-        ) for x in headers_list
-    )
+    # заголовок -> значение. Значение может содержать двоеточие,
+    # например, Host: localhost:80, поэтому делим строку только
+    # по первому. Имена заголовков не зависят от регистра, приводим
+    # их к виду Content-Length.
+    headers = {}
+    for line in headers_list:
+        name, sep, value = line.decode('utf-8').partition(':')
+        if not sep:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        headers[name.strip().title()] = value.strip()
 
     return (method, uri, headers)
 
 
+def request_keep_alive(request_line, headers):
+    """ Определяем, можно ли оставить подключение открытым после
+        ответа. В HTTP/1.1 подключение постоянное, если клиент не
+        прислал Connection: close, в HTTP/1.0 - только если прислал
+        Connection: keep-alive. Тело длиной Content-Length мы
+        пропускаем, а тело в кодировке chunked не разбираем, поэтому
+        после такого запроса подключение закрываем.
+    """
+    if "Transfer-Encoding" in headers:
+        return False
+
+    connection = headers.get("Connection", "").lower()
+    if request_line.split()[2] == b"HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+
 def get_http_timestamp():
     """ Возвращаем текущее время, отформатированное по RFC 1123. """
-    return formatdate(timeval=mktime(datetime.now().timetuple()),
-                      localtime=False, usegmt=True)
+    return format_http_date(int(time.time()))
+
+
+@functools.lru_cache(maxsize=1)
+def format_http_date(timestamp):
+    # Дата меняется раз в секунду, поэтому форматируем ее один
+    # раз для всех ответов этой секунды.
+    return formatdate(timestamp, usegmt=True)
+
+
+@functools.lru_cache(maxsize=1)
+def date_header(timestamp):
+    return f"Date: {format_http_date(timestamp)}\r\n".encode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def status_header(httpStatus, keep_alive):
+    """ Строка статуса и заголовки, которые не зависят от ответа,
+        закодированные заранее.
+    """
+    return (
+        f"HTTP/1.1 {httpStatus.value} {httpStatus.phrase}\r\n"
+        "Server: Goga\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+    ).encode("utf-8")
+
+
+def encode_headers(headers):
+    """ Кодируем словарь заголовков в блок строк для ответа. Блок можно
+        закодировать один раз и передавать в send_response много раз.
+    """
+    return ''.join(
+        f"{name}: {value}\r\n" for name, value in headers.items()
+    ).encode("utf-8")
+
+
+def send_buffers(socket, buffers):
+    """ Отправляем несколько буферов одним вызовом sendmsg, а если
+        сокет принял не все - досылаем остаток.
+    """
+    buffers = [memoryview(buffer) for buffer in buffers]
+    while buffers:
+        sent = socket.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
 
 
 def send_response(socket, httpStatus, custom_headers=None, content=None):
     """ Посылаем ответ на запрос с опциональными дополнительными
-        заголовками и данными.
+        заголовками и данными. Дополнительные заголовки передаются
+        словарем или блоком, заранее закодированным encode_headers.
+        В блоке должен быть Content-Length, если он нужен.
     """
-    headers = {
-        "Date": get_http_timestamp(),
-        "Server": "Goga",
-        "Connection": "close"
-    }
-    if custom_headers:
-        headers.update(custom_headers)
-
-    headers_str = f"HTTP/1.1 {httpStatus.value} {httpStatus.phrase}\r\n"
-    headers_str += '\r\n'.join(
-        map(lambda x: f"{x[0]}: {x[1]}", headers.items())
-    )
-    headers_str += '\r\n\r\n'
-
-    socket.sendall(headers_str.encode("utf-8"))
+    if isinstance(custom_headers, bytes):
+        headers = custom_headers
+    else:
+        headers = dict(custom_headers) if custom_headers else {}
+        # На постоянном подключении клиент узнает конец ответа только
+        # по его длине, поэтому она нужна и у ответов об ошибках.
+        # Ответ 304 тела не имеет никогда.
+        if "Content-Length" not in headers and httpStatus != HTTPStatus.NOT_MODIFIED:
+            headers["Content-Length"] = len(content) if content else 0
+        headers = encode_headers(headers)
+
+    # Заголовки и тело уходят одним системным вызовом.
+    buffers = [
+        status_header(httpStatus, getattr(socket, "keep_alive", False)),
+        date_header(int(time.time())),
+        headers,
+        b"\r\n"
+    ]
     if content:
-        socket.sendall(content)
+        buffers.append(content)
+    send_buffers(socket, buffers)
+
+
+class FileSegment(object):
+    """ Часть файла, которую нужно отправить в сокет. Данные уходят
+        из файла в сокет через os.sendfile, не копируясь в память
+        процесса. Если os.sendfile не поддерживается для этого файла,
+        читаем и отправляем его кусками.
+    """
+
+    def __init__(self, file, offset, count):
+        # Обработчик закроет файл сразу после вызова sendfile,
+        # поэтому держим свою копию дескриптора.
+        self.fd = os.dup(file.fileno())
+        self.regular = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.use_sendfile = self.regular and hasattr(os, "sendfile")
+        self.offset = offset
+        self.count = count
+
+    def send(self, socket):
+        """ Отправляем сколько получится. Возвращаем True, если
+            отправили все. Если сокет не готов к записи, бросаем
+            BlockingIOError.
+        """
+        while self.count:
+            if self.use_sendfile:
+                try:
+                    sent = os.sendfile(socket.fileno(), self.fd, self.offset, self.count)
+                except OSError as ex:
+                    if ex.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+                    self.use_sendfile = False
+                    continue
+            else:
+                size = min(self.count, SENDFILE_CHUNK)
+                if self.regular:
+                    data = os.pread(self.fd, size, self.offset)
+                else:
+                    data = os.read(self.fd, size)
+                sent = socket.send(data) if data else 0
+            if not sent:
+                # Файл стал короче, чем обещали в Content-Length.
+                raise OSError(errno.EIO, "File truncated")
+            self.offset += sent
+            self.count -= sent
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Connection(object):
+    """ Подключение клиента в событийном движке. Обработчик пишет в него
+        так же, как в сокет, методом sendall, но данные копятся в буфере
+        и отправляются, когда сокет готов к записи. Атрибут keep_alive
+        говорит, оставить ли подключение открытым после ответа.
+    """
+
+    def __init__(self, socket, addr):
+        self.socket = socket
+        self.addr = addr
+        self.reader = RequestReader()
+        self.output = collections.deque()
+        self.keep_alive = False
+        self.closing = False
+        self.last_active = time.monotonic()
+
+    @staticmethod
+    def frozen(data):
+        """ Возвращаем memoryview на данные. Неизменяемые bytes ставим в
+            очередь без копирования, изменяемые буферы копируем, чтобы
+            их не поменяли до отправки.
+        """
+        view = memoryview(data)
+        if not view.readonly:
+            view = memoryview(bytes(view))
+        return view
+
+    def sendall(self, data):
+        self.output.append(self.frozen(data))
+
+    def sendmsg(self, buffers):
+        """ Ставим буферы в очередь. Из очереди они уходят вместе
+            одним вызовом sendmsg.
+        """
+        size = 0
+        for buffer in buffers:
+            buffer = self.frozen(buffer)
+            self.output.append(buffer)
+            size += len(buffer)
+        return size
+
+    def sendfile(self, file, offset=0, count=None):
+        """ Ставим в очередь отправку части файла. Повторяет сигнатуру
+            socket.sendfile, поэтому обработчик может вызывать ее
+            одинаково для сокета и для Connection.
+        """
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        self.output.append(FileSegment(file, offset, count))
+
+    def flush(self):
+        """ Отправляем сколько получится из выходного буфера. Возвращаем
+            True, если буфер опустел.
+        """
+        while self.output:
+            item = self.output[0]
+            if isinstance(item, FileSegment):
+                try:
+                    item.send(self.socket)
+                except (BlockingIOError, InterruptedError):
+                    return False
+                item.close()
+                self.output.popleft()
+                continue
+
+            # Все буферы до следующего файла отправляем одним вызовом:
+            # так заголовки, тело и ответы на конвейерные запросы
+            # уходят вместе.
+            buffers = []
+            for item in self.output:
+                if isinstance(item, FileSegment) or len(buffers) == IOV_MAX:
+                    break
+                buffers.append(item)
+            try:
+                sent = self.socket.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            for buffer in buffers:
+                if sent < len(buffer):
+                    self.output[0] = buffer[sent:]
+                    return False
+                sent -= len(buffer)
+                self.output.popleft()
+        return True
+
+    def close(self):
+        for item in self.output:
+            if isinstance(item, FileSegment):
+                item.close()
+        self.output.clear()
+        self.socket.close()
+
+
+class EventWorker(object):
+    """ Обработчик подключений на основе `selectors` (epoll в Linux).
+        Один процесс обслуживает много подключений: читает запросы,
+        когда сокет готов к чтению, и отправляет ответы, когда сокет
+        готов к записи. Поддерживает постоянные подключения и
+        конвейерную обработку: все запросы, которые пришли в одном
+        пакете, обрабатываются по очереди, а ответы отправляются в
+        том же порядке.
+    """
+
+    def __init__(self, listener, handler, doc_root, counts=None, index=0):
+        self.listener = listener
+        self.handler = handler
+        self.doc_root = doc_root
+        self.counts = counts
+        self.index = index
+        self.selector = selectors.DefaultSelector()
+        # До какого момента (time.monotonic) слушающий сокет снят с
+        # ожидания после ошибки accept.
+        self.accept_paused = None
+
+    def run(self):
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        checked = time.monotonic()
+        while True:
+            for key, events in self.selector.select(timeout=1):
+                if key.data is None:
+                    self.accept()
+                elif events & selectors.EVENT_WRITE:
+                    self.write(key.data)
+                else:
+                    self.read(key.data)
+
+            now = time.monotonic()
+            if self.accept_paused and now >= self.accept_paused:
+                self.accept_paused = None
+                self.selector.register(self.listener, selectors.EVENT_READ)
+            if now - checked >= 1:
+                self.close_idle(now)
+                checked = now
+
+    def close_idle(self, now):
+        """ Закрываем подключения, от которых READ_TIMEOUT секунд не было
+            данных и которые не ждут отправки ответа.
+        """
+        for key in list(self.selector.get_map().values()):
+            conn = key.data
+            if conn and not conn.output and now - conn.last_active > READ_TIMEOUT:
+                self.close(conn)
+
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                if ex.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # Подключение остается в очереди, и без паузы select
+                    # сразу вернет слушающий сокет снова.
+                    logging.error(f'Cannot accept connection: {ex}')
+                    self.selector.unregister(self.listener)
+                    self.accept_paused = time.monotonic() + ACCEPT_PAUSE
+                    return
+                # Клиент закрыл подключение раньше, чем оно было принято.
+                logging.info(f'Skip connection: {ex}')
+                continue
+            logging.info(f'Accept connection from {addr}')
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.selector.register(sock, selectors.EVENT_READ, Connection(sock, addr))
+
+    def read(self, conn):
+        try:
+            size = conn.reader.receive(conn.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            size = 0
+        if not size:
+            self.close(conn)
+            return
+
+        conn.last_active = time.monotonic()
+        self.process(conn)
+
+    def write(self, conn):
+        try:
+            flushed = conn.flush()
+        except OSError:
+            self.close(conn)
+            return
+        if flushed:
+            self.selector.modify(conn.socket, selectors.EVENT_READ, conn)
+            self.process(conn)
+
+    def process(self, conn):
+        """ Обрабатываем все запросы, которые есть во входном буфере,
+            и отправляем ответы. Если сокет не принял ответ целиком,
+            ждем готовности к записи и до тех пор не читаем новые
+            запросы.
+        """
+        while True:
+            request = None
+            while not conn.closing and len(conn.output) < PIPELINE_LIMIT:
+                try:
+                    request = conn.reader.next_request()
+                except HttpError as ex:
+                    conn.keep_alive = False
+                    conn.closing = True
+                    send_response(conn, ex.httpStatus, ex.headers)
+                    break
+                if not request:
+                    break
+                self.handle(conn, *request)
+
+            try:
+                flushed = conn.flush()
+            except OSError:
+                self.close(conn)
+                return
+            if not flushed:
+                self.selector.modify(conn.socket, selectors.EVENT_WRITE, conn)
+                return
+            if conn.closing:
+                self.close(conn)
+                return
+            if not request:
+                return
+
+    def handle(self, conn, request_line, headers_list):
+        dispatch(conn, request_line, headers_list, self.handler, self.doc_root)
+        if not conn.keep_alive:
+            conn.closing = True
+        if self.counts:
+            self.counts[self.index] += 1
+
+    def close(self, conn):
+        self.selector.unregister(conn.socket)
+        conn.close()
+
+
+def dispatch(conn, request_line, headers_list, handler, doc_root):
+    """ Разбираем запрос с постоянного подключения, передаем его в
+        обработчик `handler` и решаем, оставить ли подключение
+        открытым.
+    """
+    try:
+        method, uri, headers = parse_request(request_line, headers_list)
+        conn.keep_alive = request_keep_alive(request_line, headers)
+        conn.reader.skip_body(headers)
+        handler(conn, method, uri, headers, doc_root)
+    except HttpError as ex:
+        logging.info(
+            f"Response {ex.httpStatus.value} {ex.httpStatus.phrase}"
+        )
+        if ex.httpStatus == HTTPStatus.BAD_REQUEST:
+            conn.keep_alive = False
+        send_response(conn, ex.httpStatus, ex.headers)
+    except Exception as ex:
+        logging.exception(ex)
+        conn.keep_alive = False
+        send_response(conn, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
+class AsyncConnection(Connection):
+    """ Подключение клиента в движке asyncio. Обработчик пишет в него
+        так же, как в Connection, а метод drain отправляет накопленный
+        ответ через StreamWriter, файлы - через loop.sendfile.
+    """
+
+    def __init__(self, writer):
+        super().__init__(writer.get_extra_info('socket'),
+                         writer.get_extra_info('peername'))
+        self.writer = writer
+
+    async def drain(self):
+        loop = asyncio.get_running_loop()
+        while self.output:
+            item = self.output.popleft()
+            if not isinstance(item, FileSegment):
+                self.writer.write(item)
+                continue
+
+            await self.writer.drain()
+            try:
+                with open(item.fd, 'rb', closefd=False) as file:
+                    await loop.sendfile(self.writer.transport, file,
+                                        item.offset, item.count)
+            finally:
+                item.close()
+        await self.writer.drain()
+
+    def close(self):
+        for item in self.output:
+            if isinstance(item, FileSegment):
+                item.close()
+        self.output.clear()
+        self.writer.close()
+
+
+async def serve_async_connection(reader, writer, handler, doc_root, counts, index):
+    """ Обслуживаем постоянное подключение в движке asyncio: читаем
+        запросы, передаем их в обработчик и отправляем ответы, пока
+        клиент не закроет подключение или не замолчит на READ_TIMEOUT
+        секунд.
+    """
+    conn = AsyncConnection(writer)
+    logging.info(f'Accept connection from {conn.addr}')
+    try:
+        while True:
+            try:
+                request = conn.reader.next_request()
+            except HttpError as ex:
+                conn.keep_alive = False
+                send_response(conn, ex.httpStatus, ex.headers)
+                await conn.drain()
+                break
+
+            if not request:
+                data = await asyncio.wait_for(reader.read(RECV_SIZE), READ_TIMEOUT)
+                if not data:
+                    break
+                conn.reader.buffer += data
+                continue
+
+            dispatch(conn, *request, handler, doc_root)
+            await conn.drain()
+            counts[index] += 1
+            if not conn.keep_alive:
+                break
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        conn.close()
+
+
+async def serve_async(host, port, handler, doc_root, counts, index):
+    server = await asyncio.start_server(
+        functools.partial(serve_async_connection, handler=handler,
+                          doc_root=doc_root, counts=counts, index=index),
+        host, port, reuse_port=True, backlog=socket.SOMAXCONN
+    )
+    async with server:
+        await server.serve_forever()
 
 
 class HttpServer(object):
@@ -111,20 +679,39 @@ class HttpServer(object):
         в конструктор через параметр handler. Сервер принимает
         подключение, создает экземпляр HttpRequest и вызывает
         функцию - обработчик, передавая ей HttpRequest.
+
+        С engine="prefork" главный процесс только открывает сокет и
+        запускает процессы, каждый из которых сам вызывает accept()
+        на унаследованном сокете. С engine="event" каждый процесс
+        открывает свой сокет с SO_REUSEPORT и обслуживает подключения
+        в цикле событий `EventWorker`, с engine="asyncio" - в цикле
+        событий asyncio. Во всех трех режимах главный процесс
+        перезапускает упавшие процессы и пишет в лог, сколько запросов
+        обработал каждый.
     """
 
-    def __init__(self, host, port, doc_root, workers_num, log_level, handler):
+    def __init__(self, host, port, doc_root, workers_num, log_level, handler,
+                 engine="pool"):
         self.host = host
         self.port = port
         self.workers_num = workers_num
         self.doc_root = doc_root
         self.log_level = log_level
         self.handler = handler
+        self.engine = engine
+        self.pool = None
+        self.socket = None
+        self.workers = []
+        self.counts = None
 
     def start(self):
         """ Запускаем сервер, инициализируем пул процессов и
             принимающий запросы сокет.
         """
+        if self.engine in ("prefork", "event", "asyncio"):
+            self.supervise()
+            return
+
         self.pool = Pool(
                 processes=self.workers_num,
                 initializer=HttpServer.worker_init
@@ -144,14 +731,78 @@ class HttpServer(object):
                 (conn, self.handler, self.doc_root, self.log_level)
             )
 
+    def supervise(self):
+        """ Запускаем процессы, перезапускаем завершившиеся и раз в
+            STATS_INTERVAL секунд пишем в лог число обработанных ими
+            запросов.
+        """
+        if self.engine == "prefork":
+            self.socket = HttpServer.listen_socket(self.host, self.port, reuse_port=False)
+        logging.info(f'Start server on {(self.host, self.port)}')
+
+        self.counts = Array('Q', self.workers_num, lock=False)
+        self.workers = [self.start_worker(index) for index in range(self.workers_num)]
+        started = [time.monotonic()] * self.workers_num
+        reported = time.monotonic()
+
+        while True:
+            wait([worker.sentinel for worker in self.workers], STATS_INTERVAL)
+            for index, worker in enumerate(self.workers):
+                if worker.is_alive():
+                    continue
+                logging.warning(
+                    f'Worker {worker.pid} exited with code {worker.exitcode}, restart'
+                )
+                if time.monotonic() - started[index] < RESTART_DELAY:
+                    time.sleep(RESTART_DELAY)
+                self.workers[index] = self.start_worker(index)
+                started[index] = time.monotonic()
+
+            if time.monotonic() - reported >= STATS_INTERVAL:
+                self.log_counts()
+                reported = time.monotonic()
+
+    def start_worker(self, index):
+        if self.engine == "prefork":
+            target = HttpServer.prefork_worker
+            args = (self.socket, )
+        elif self.engine == "asyncio":
+            target = HttpServer.asyncio_worker
+            args = (self.host, self.port)
+        else:
+            target = HttpServer.event_worker
+            args = (self.host, self.port)
+
+        worker = Process(
+            target=target,
+            args=args + (self.handler, self.doc_root, self.log_level,
+                         self.counts, index),
+            daemon=True
+        )
+        worker.start()
+        return worker
+
+    def log_counts(self):
+        logging.info('Requests per worker: ' + ', '.join(
+            f'{worker.pid}: {count}'
+            for worker, count in zip(self.workers, self.counts)
+        ))
+
     def stop(self):
         """ Останавливаем сервер, закрываем сокет, дожидаемся завершения
             процессов из пула.
         """
         logging.info('Stop server')
-        self.socket.close()
-        self.pool.close()
-        self.pool.join()
+        if self.socket:
+            self.socket.close()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        if self.counts:
+            self.log_counts()
 
     @staticmethod
     def worker_init():
@@ -161,13 +812,66 @@ class HttpServer(object):
         """
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    @staticmethod
+    def listen_socket(host, port, reuse_port=True):
+        """ Открываем принимающий сокет. С reuse_port каждый процесс
+            может открыть свой сокет на том же порту с SO_REUSEPORT, а
+            ядро распределит между ними подключения.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+        return sock
+
+    @staticmethod
+    def event_worker(host, port, handler, doc_root, log_level, counts, index):
+        """ Процесс событийного движка. """
+        HttpServer.worker_init()
+        logging.basicConfig(level=log_level)
+        listener = HttpServer.listen_socket(host, port)
+        EventWorker(listener, handler, doc_root, counts, index).run()
+
+    @staticmethod
+    def asyncio_worker(host, port, handler, doc_root, log_level, counts, index):
+        """ Процесс движка asyncio. """
+        HttpServer.worker_init()
+        logging.basicConfig(level=log_level)
+        asyncio.run(serve_async(host, port, handler, doc_root, counts, index))
+
+    @staticmethod
+    def prefork_worker(listener, handler, doc_root, log_level, counts, index):
+        """ Процесс режима prefork. Принимаем подключения на общем
+            сокете и обслуживаем их по одному.
+        """
+        HttpServer.worker_init()
+        logging.basicConfig(level=log_level)
+        while True:
+            conn, addr = listener.accept()
+            logging.info(f'Accept connection from {addr}')
+            try:
+                HttpServer.serve(conn, handler, doc_root)
+            except OSError as ex:
+                logging.info(f'Connection error: {ex}')
+            counts[index] += 1
+
     @staticmethod
     def worker(socket, handler, doc_root, log_level):
         """ Получаем сокет для работы с клиентом. Читаем данные запроса,
             парсим их и передаем результаты в обработчик `handler`.
         """
         logging.basicConfig(level=log_level)
+        HttpServer.serve(socket, handler, doc_root)
 
+    @staticmethod
+    def serve(socket, handler, doc_root):
+        """ Обслуживаем один запрос на подключении и закрываем его.
+            Постоянные подключения здесь не поддерживаются: процесс
+            был бы занят клиентом, пока тот не закроет подключение.
+        """
+        socket.settimeout(READ_TIMEOUT)
         try:
             request_line, headers_list = read_request(socket)
             method, uri, headers = parse_request(request_line, headers_list)
@@ -176,7 +880,7 @@ class HttpServer(object):
             logging.info(
                 f"Response {ex.httpStatus.value} {ex.httpStatus.phrase}"
             )
-            send_response(socket, ex.httpStatus)
+            send_response(socket, ex.httpStatus, ex.headers)
         except Exception as ex:
             logging.exception(ex)
             send_response(socket, HTTPStatus.INTERNAL_SERVER_ERROR)
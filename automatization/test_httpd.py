@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import errno
+import gzip
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from os import path
+from httpserver import RequestReader, HttpError, Connection
+from httpserver import parse_request, request_keep_alive, EventWorker, HttpServer
+from httpserver import FileSegment, serve_async, SENDFILE_CHUNK
+from httpd import parse_range, not_modified, accept_encoding, handle_request, FileCache
+
+
+testEntry = namedtuple("entry", ["size", "etag", "last_modified", "mtime"])
+
+LAST_MODIFIED = 'Sat, 17 Oct 2026 06:10:47 GMT'
+ENTRY = testEntry(100, '"abc-64"', LAST_MODIFIED,
+                  int(parsedate_to_datetime(LAST_MODIFIED).timestamp()))
+
+
+def read_response(conn):
+    """ Разбираем ответ, который handle_request поставил в очередь
+        подключения: статус, заголовки и тело.
+    """
+    data = b''.join(bytes(item) for item in conn.output)
+    head, _, body = data.partition(b'\r\n\r\n')
+    lines = head.decode().split('\r\n')
+    headers = dict(line.split(': ', 1) for line in lines[1:])
+    return int(lines[0].split()[1]), headers, body
+
+
+def read_http_response(file):
+    """ Читаем из файла сокета один ответ: статус, заголовки и тело
+        длиной Content-Length.
+    """
+    status_line = file.readline()
+    if not status_line:
+        return None
+    headers = {}
+    for line in iter(file.readline, b'\r\n'):
+        name, value = line.decode().rstrip('\r\n').split(': ', 1)
+        headers[name] = value
+    body = file.read(int(headers.get('Content-Length', 0)))
+    return int(status_line.split()[1]), headers, body
+
+
+def run_event_engine(listener, doc_root):
+    EventWorker(listener, handle_request, doc_root).run()
+
+
+def run_asyncio_engine(port, doc_root):
+    asyncio.run(serve_async('127.0.0.1', port, handle_request, doc_root, [0], 0))
+
+
+def crashing_handler(socket, method, uri, headers, doc_root):
+    if uri == '/crash':
+        os._exit(1)
+    handle_request(socket, method, uri, headers, doc_root)
+
+
+def run_supervised(port, doc_root):
+    server = HttpServer('127.0.0.1', port, doc_root, 1, logging.WARNING,
+                        crashing_handler, engine='event')
+    # terminate() из теста должен остановить и процессы сервера.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.supervise()
+    finally:
+        server.stop()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestRequestReader(unittest.TestCase):
+    def test_split_delimiter(self):
+        reader = RequestReader()
+        for chunk in (b'GET / HTTP/1.1\r\nHost: a\r', b'\n\r', b'\n'):
+            self.assertIsNone(reader.next_request())
+            reader.buffer += chunk
+        self.assertEqual(reader.next_request(), (b'GET / HTTP/1.1', [b'Host: a']))
+        self.assertEqual(reader.buffer, b'')
+
+    def test_headers_limit(self):
+        reader = RequestReader(max_size=100)
+        reader.buffer += b'GET / HTTP/1.1\r\nX-A: ' + b'a' * 200
+        with self.assertRaises(HttpError) as ctx:
+            reader.next_request()
+        self.assertEqual(ctx.exception.httpStatus, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+    def test_body_and_pipelined(self):
+        reader = RequestReader()
+        reader.buffer += (b'\r\nPOST / HTTP/1.1\r\nContent-Length: 5\r\n\r\nab')
+        request_line, headers_list = reader.next_request()
+        self.assertEqual(request_line, b'POST / HTTP/1.1')
+        reader.skip_body(parse_request(request_line, headers_list)[2])
+
+        self.assertIsNone(reader.next_request())
+        reader.buffer += b'cdeGET /1 HTTP/1.1\r\n\r\nGET /2 HTTP/1.1\r\n\r\nGET'
+        self.assertEqual(reader.next_request(), (b'GET /1 HTTP/1.1', []))
+        self.assertEqual(reader.next_request(), (b'GET /2 HTTP/1.1', []))
+        self.assertIsNone(reader.next_request())
+        self.assertEqual(reader.buffer, b'GET')
+
+    def test_bad_content_length(self):
+        with self.assertRaises(HttpError):
+            RequestReader().skip_body({"Content-Length": "x"})
+
+
+class TestHttpServer(unittest.TestCase):
+    def test_parse_request(self):
+        method, uri, headers = parse_request(
+            b'GET /a?b HTTP/1.1', [b'host: localhost:80', b'IF-NONE-MATCH: "x"'])
+        self.assertEqual((method, uri), ('GET', '/a?b'))
+        self.assertDictEqual(headers, {'Host': 'localhost:80', 'If-None-Match': '"x"'})
+
+        with self.assertRaises(HttpError):
+            parse_request(b'GET / HTTP/1.1', [b'Host'])
+
+    def test_request_keep_alive(self):
+        self.assertTrue(request_keep_alive(b'GET / HTTP/1.1', {}))
+        self.assertTrue(request_keep_alive(b'GET / HTTP/1.1', {'Content-Length': '5'}))
+        self.assertFalse(request_keep_alive(b'GET / HTTP/1.1', {'Connection': 'close'}))
+        self.assertFalse(request_keep_alive(b'GET / HTTP/1.1', {'Transfer-Encoding': 'chunked'}))
+        self.assertFalse(request_keep_alive(b'GET / HTTP/1.0', {}))
+        self.assertTrue(request_keep_alive(b'GET / HTTP/1.0', {'Connection': 'Keep-Alive'}))
+
+
+class FailingListener(socket.socket):
+    """ Слушающий сокет, accept которого по очереди бросает ошибки. """
+
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = list(errors)
+
+    def accept(self):
+        raise self.errors.pop(0)
+
+
+class TestEventWorker(unittest.TestCase):
+    def make_worker(self, errors):
+        listener = FailingListener(errors)
+        self.addCleanup(listener.close)
+        worker = EventWorker(listener, None, None)
+        worker.selector.register(listener, selectors.EVENT_READ)
+        return worker
+
+    def test_accept_too_many_files(self):
+        worker = self.make_worker([OSError(errno.EMFILE, 'Too many open files')])
+        with self.assertLogs(level='ERROR'):
+            worker.accept()
+        self.assertNotIn(worker.listener, worker.selector.get_map())
+        self.assertIsNotNone(worker.accept_paused)
+
+    def test_accept_aborted(self):
+        worker = self.make_worker([ConnectionAbortedError(errno.ECONNABORTED, 'aborted'),
+                                   BlockingIOError()])
+        worker.accept()
+        self.assertIn(worker.listener, worker.selector.get_map())
+        self.assertIsNone(worker.accept_paused)
+
+
+class TestFileSegment(unittest.TestCase):
+    def test_chunked_send(self):
+        data = os.urandom(SENDFILE_CHUNK * 2 + 100)
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            segment = FileSegment(file, 10, len(data) - 10)
+        segment.use_sendfile = False
+
+        left, right = socket.socketpair()
+        with left, right:
+            received = []
+            reader = threading.Thread(
+                target=lambda: received.extend(iter(lambda: right.recv(65536), b'')))
+            reader.start()
+            self.assertTrue(segment.send(left))
+            left.shutdown(socket.SHUT_WR)
+            reader.join()
+        segment.close()
+        self.assertEqual(b''.join(received), data[10:])
+
+    def test_truncated_file(self):
+        with tempfile.TemporaryFile() as file:
+            file.write(b'x' * 100)
+            segment = FileSegment(file, 0, 200)
+        segment.use_sendfile = False
+
+        left, right = socket.socketpair()
+        with left, right:
+            with self.assertRaises(OSError) as ctx:
+                segment.send(left)
+        segment.close()
+        self.assertEqual(ctx.exception.errno, errno.EIO)
+
+
+class ServerTestsMixin(object):
+    """ Тесты движка на настоящем сервере: процесс сервера слушает
+        порт на loopback, клиент ходит к нему через сокет.
+    """
+
+    def start_server(self, doc_root):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.test_path = self.test_dir.name
+        with open(path.join(self.test_path, 'small.html'), 'wb') as f:
+            f.write(b'<html>small</html>')
+        self.large = os.urandom(1024 * 1024 + 17)
+        with open(path.join(self.test_path, 'large.jpg'), 'wb') as f:
+            f.write(self.large)
+
+        self.server, self.port = self.start_server(self.test_path)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.join()
+        self.test_dir.cleanup()
+
+    def connect(self):
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+                continue
+            self.addCleanup(sock.close)
+            file = sock.makefile('rb')
+            self.addCleanup(file.close)
+            return sock, file
+
+    def test_keep_alive(self):
+        sock, file = self.connect()
+        for uri in ('/small.html', '/large.jpg', '/small.html'):
+            sock.sendall(f'GET {uri} HTTP/1.1\r\nHost: test\r\n\r\n'.encode())
+            status, headers, body = read_http_response(file)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['Connection'], 'keep-alive')
+            self.assertEqual(body, self.large if uri == '/large.jpg' else b'<html>small</html>')
+
+    def test_pipelined(self):
+        sock, file = self.connect()
+        uris = ['/large.jpg', '/small.html', '/missing.html', '/large.jpg', '/small.html']
+        sock.sendall(b''.join(f'GET {uri} HTTP/1.1\r\nHost: test\r\n\r\n'.encode()
+                              for uri in uris))
+        for uri in uris:
+            status, _, body = read_http_response(file)
+            if uri == '/missing.html':
+                self.assertEqual(status, 404)
+            else:
+                self.assertEqual(status, 200)
+                self.assertEqual(body, self.large if uri == '/large.jpg' else b'<html>small</html>')
+
+    def test_connection_close(self):
+        sock, file = self.connect()
+        sock.sendall(b'GET /large.jpg HTTP/1.1\r\nConnection: close\r\n\r\n'
+                     b'GET /small.html HTTP/1.1\r\n\r\n')
+        status, headers, body = read_http_response(file)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Connection'], 'close')
+        self.assertEqual(body, self.large)
+        self.assertIsNone(read_http_response(file))
+
+
+class TestEventEngine(ServerTestsMixin, unittest.TestCase):
+    def start_server(self, doc_root):
+        listener = HttpServer.listen_socket('127.0.0.1', 0, reuse_port=False)
+        with listener:
+            server = multiprocessing.get_context('fork').Process(
+                target=run_event_engine, args=(listener, doc_root), daemon=True)
+            server.start()
+            return server, listener.getsockname()[1]
+
+
+class TestAsyncioEngine(ServerTestsMixin, unittest.TestCase):
+    def start_server(self, doc_root):
+        port = free_port()
+        server = multiprocessing.get_context('fork').Process(
+            target=run_asyncio_engine, args=(port, doc_root), daemon=True)
+        server.start()
+        return server, port
+
+
+class TestSupervise(ServerTestsMixin, unittest.TestCase):
+    def start_server(self, doc_root):
+        port = free_port()
+        server = multiprocessing.get_context('fork').Process(
+            target=run_supervised, args=(port, doc_root))
+        server.start()
+        return server, port
+
+    def get(self, uri):
+        """ Запрос на новом подключении. Если сервер сбросил
+            подключение, возвращаем None.
+        """
+        sock, file = self.connect()
+        sock.sendall(f'GET {uri} HTTP/1.1\r\n\r\n'.encode())
+        try:
+            return read_http_response(file)
+        except ConnectionResetError:
+            return None
+
+    def test_restart(self):
+        self.assertIsNone(self.get('/crash'))
+
+        # Главный процесс запустит новый процесс через RESTART_DELAY.
+        # Пока упавший процесс не закрыл сокет, подключения к нему
+        # сбрасываются.
+        deadline = time.monotonic() + 5
+        response = self.get('/small.html')
+        while not response and time.monotonic() < deadline:
+            time.sleep(0.05)
+            response = self.get('/small.html')
+        self.assertEqual(response[0], 200)
+        self.assertEqual(response[2], b'<html>small</html>')
+
+
+class TestHttpd(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.test_path = self.test_dir.name
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range({'Range': 'bytes=2-4'}, ENTRY), (2, 4))
+        self.assertEqual(parse_range({'Range': 'bytes=90-'}, ENTRY), (90, 99))
+        self.assertEqual(parse_range({'Range': 'bytes=90-200'}, ENTRY), (90, 99))
+        self.assertEqual(parse_range({'Range': 'bytes=-10'}, ENTRY), (90, 99))
+        self.assertEqual(parse_range({'Range': 'bytes=-200'}, ENTRY), (0, 99))
+        self.assertIsNone(parse_range({}, ENTRY))
+        self.assertIsNone(parse_range({'Range': 'bytes=5-2'}, ENTRY))
+        self.assertIsNone(parse_range({'Range': 'bytes=0-1,5-6'}, ENTRY))
+        self.assertIsNone(parse_range({'Range': 'items=0-1'}, ENTRY))
+        self.assertEqual(parse_range({'Range': 'bytes=0-1', 'If-Range': '"abc-64"'}, ENTRY), (0, 1))
+        self.assertIsNone(parse_range({'Range': 'bytes=0-1', 'If-Range': '"old"'}, ENTRY))
+
+        for value in ('bytes=100-', 'bytes=-0'):
+            with self.assertRaises(HttpError) as ctx:
+                parse_range({'Range': value}, ENTRY)
+            self.assertEqual(ctx.exception.httpStatus, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.assertDictEqual(ctx.exception.headers, {'Content-Range': 'bytes */100'})
+
+    def test_not_modified(self):
+        etag = ENTRY.etag
+        self.assertTrue(not_modified(ENTRY, {'If-None-Match': '"x", "abc-64"'}, etag))
+        self.assertTrue(not_modified(ENTRY, {'If-None-Match': 'W/"abc-64"'}, etag))
+        self.assertTrue(not_modified(ENTRY, {'If-None-Match': '*'}, etag))
+        self.assertFalse(not_modified(ENTRY, {'If-None-Match': '"abc-64-gzip"'}, etag))
+        self.assertTrue(not_modified(ENTRY, {'If-Modified-Since': ENTRY.last_modified}, etag))
+        self.assertFalse(not_modified(ENTRY, {'If-Modified-Since': 'Sat, 17 Oct 2026 06:10:46 GMT'}, etag))
+        self.assertFalse(not_modified(ENTRY, {'If-Modified-Since': 'yesterday'}, etag))
+        # If-None-Match важнее If-Modified-Since.
+        self.assertFalse(not_modified(
+            ENTRY, {'If-None-Match': '"x"', 'If-Modified-Since': ENTRY.last_modified}, etag))
+
+    def test_file_cache_changed(self):
+        file_path = path.join(self.test_path, 'page.html')
+        with open(file_path, 'w') as f:
+            f.write('first')
+        cache = FileCache(check_interval=0)
+        entry = cache.get(self.test_path, '/page.html')
+        self.assertIs(cache.get(self.test_path, '/page.html'), entry)
+
+        # Новый размер.
+        with open(file_path, 'w') as f:
+            f.write('second')
+        changed = cache.get(self.test_path, '/page.html')
+        self.assertEqual(changed.read(), b'second')
+
+        # Тот же размер, другое время изменения.
+        with open(file_path, 'w') as f:
+            f.write('third!')
+        os.utime(file_path, ns=(0, os.stat(file_path).st_mtime_ns + 10 ** 9))
+        entry = cache.get(self.test_path, '/page.html')
+        self.assertEqual(entry.read(), b'third!')
+        self.assertNotEqual(entry.etag, changed.etag)
+
+    def test_accept_encoding(self):
+        self.assertEqual(accept_encoding({'Accept-Encoding': 'deflate, gzip;q=0.5'}), 'gzip')
+        self.assertIn(accept_encoding({'Accept-Encoding': '*'}), ('br', 'gzip'))
+        self.assertIsNone(accept_encoding({'Accept-Encoding': 'gzip;q=0, br;q=0'}))
+        self.assertIsNone(accept_encoding({'Accept-Encoding': '*;q=0'}))
+        self.assertIsNone(accept_encoding({'Accept-Encoding': 'identity'}))
+        self.assertIsNone(accept_encoding({}))
+
+    def request(self, uri, headers):
+        conn = Connection(None, None)
+        handle_request(conn, 'GET', uri, headers, self.test_path)
+        return read_response(conn)
+
+    def test_compressed_variant(self):
+        with open(path.join(self.test_path, 'text.txt'), 'w') as f:
+            f.write('hello world\n' * 1000)
+
+        status, headers, body = self.request('/text.txt', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(body), b'hello world\n' * 1000)
+
+        status, _, _ = self.request('/text.txt', {'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+        status, plain_headers, body = self.request('/text.txt', {'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 200)
+        self.assertNotIn('Content-Encoding', plain_headers)
+        self.assertEqual(len(body), 12000)
+
+    def test_incompressible_not_modified(self):
+        with open(path.join(self.test_path, 'random.txt'), 'wb') as f:
+            f.write(os.urandom(5000))
+
+        status, headers, body = self.request('/random.txt', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(len(body), 5000)
+
+        status, not_modified_headers, body = self.request(
+            '/random.txt', {'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(not_modified_headers['ETag'], headers['ETag'])
+        self.assertEqual(body, b'')
+
+    def test_range_request(self):
+        with open(path.join(self.test_path, 'text.txt'), 'w') as f:
+            f.write('0123456789' * 100)
+
+        status, headers, body = self.request('/text.txt', {'Accept-Encoding': 'gzip', 'Range': 'bytes=5-14'})
+        self.assertEqual(status, 206)
+        self.assertEqual(headers['Content-Range'], 'bytes 5-14/1000')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, b'5678901234')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,11 @@ import os
 import gzip
 import sys
 import glob
+import shutil
 import logging
+import subprocess
 import collections
+import contextlib
 from optparse import OptionParser
 # brew install protobuf
 # protoc  --python_out=. ./appsinstalled.proto
@@ -17,6 +20,11 @@ import threading
 import time
 
 NORMAL_ERR_RATE = 0.01
+PIPE_BUFFER_SIZE = 1024 * 1024
+GZIP_COMMANDS = {
+    "pigz": ["pigz", "-dc"],
+    "zcat": ["gzip", "-dc"],
+}
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
 
 
@@ -77,6 +85,39 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
+@contextlib.contextmanager
+def open_gzip_pipe(command, path):
+    # Decompression runs in a separate process, in parallel with parsing
+    process = subprocess.Popen(command + [path], stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE)
+    finished = False
+    try:
+        yield process.stdout
+        # EOF means the command closed its output, so its exit code matters;
+        # otherwise the file was left unread and the command is killed
+        finished = not process.stdout.read(1)
+    finally:
+        if not finished:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+
+    if finished and returncode:
+        raise IOError("%s exited with code %s on %s" % (command[0], returncode, path))
+
+
+def open_gz(path, backend="auto"):
+    if backend == "auto":
+        backend = "gzip"
+        for name, command in GZIP_COMMANDS.items():
+            if shutil.which(command[0]):
+                backend = name
+                break
+
+    if backend in GZIP_COMMANDS:
+        return open_gzip_pipe(GZIP_COMMANDS[backend], path)
+    return gzip.open(path)
+
+
 def insert_appsinstalled(memc_client, appsinstalled, dry_run=False):
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
@@ -145,22 +186,21 @@ def main(options):
         for fn in glob.iglob(options.pattern):
             errors = 0
             logging.info('Processing %s' % fn)
-            fd = gzip.open(fn)
-            for line in fd:
-                line = line.decode('utf-8').strip()
-                if not line:
-                    continue
-                appsinstalled = parse_appsinstalled(line)
-                if not appsinstalled:
-                    errors += 1
-                    continue
-                memc_client = device_memc.get(appsinstalled.dev_type)
-                if not memc_client:
-                    errors += 1
-                    logging.error("Unknow device type: %s" % appsinstalled.dev_type)
-                    continue
-                insert_appsinstalled(memc_client, appsinstalled, options.dry)
-            fd.close()
+            with open_gz(fn, options.gzip_backend) as fd:
+                for line in fd:
+                    line = line.decode('utf-8').strip()
+                    if not line:
+                        continue
+                    appsinstalled = parse_appsinstalled(line)
+                    if not appsinstalled:
+                        errors += 1
+                        continue
+                    memc_client = device_memc.get(appsinstalled.dev_type)
+                    if not memc_client:
+                        errors += 1
+                        logging.error("Unknow device type: %s" % appsinstalled.dev_type)
+                        continue
+                    insert_appsinstalled(memc_client, appsinstalled, options.dry)
             dot_rename(fn)
 
             print_statistics(device_memc, errors)
@@ -198,6 +238,8 @@ if __name__ == '__main__':
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option("--gzip-backend", action="store", default="auto",
+                  choices=["auto", "gzip"] + list(GZIP_COMMANDS))
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from log_analyzer import parse_line, parse_request, read_batches, logFileTuple, GZIP_COMMANDS
+from log_analyzer import collect_stats, save_report, Profiler
+
+
+LINE_FORMAT = ('{ip} {user}  - [29/Jun/2017:03:50:22 +0300] "{method} {url} HTTP/1.1" '
+               '{status} {size} "-" "{agent}" "-" "1498697422-2190034393-4708-9752759" '
+               '"dc7161be3" {time:.3f}\n')
+
+METHODS = ["GET", "GET", "GET", "POST", "HEAD"]
+AGENTS = ["Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+          "Python-urllib/2.7",
+          "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)"]
+
+
+def generate_lines(count, urls_num, seed=0):
+    rnd = random.Random(seed)
+    urls = [f"/api/v2/banner/{rnd.randrange(10 ** 8)}" for _ in range(urls_num)]
+    for _ in range(count):
+        yield LINE_FORMAT.format(
+            ip=".".join(str(rnd.randrange(256)) for _ in range(4)),
+            user=rnd.choice(["-", "3b81f63526fa8"]),
+            method=rnd.choice(METHODS),
+            url=urls[int(rnd.paretovariate(1.2)) % urls_num],
+            status=rnd.choice([200, 200, 200, 404, 500]),
+            size=rnd.randrange(100000),
+            agent=rnd.choice(AGENTS),
+            time=rnd.expovariate(5))
+
+
+def parse_regex(line):
+    report = parse_line(line.decode("utf-8").rstrip("\n"))
+    if report:
+        return report[4].split()[1], float(report[12])
+
+
+def bench_parser(name, parser, lines):
+    start = time.perf_counter()
+    for line in lines:
+        parser(line)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {len(lines) / elapsed:12.0f} lines/s")
+
+
+def bench_gzip(lines):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630.gz")
+        with gzip.open(log_path, "wt") as file:
+            file.writelines(lines)
+        log = logFileTuple(log_path, None, True)
+
+        backends = ["gzip", "zlib"] + [backend for backend, command in GZIP_COMMANDS.items()
+                                       if shutil.which(command[0])]
+        for backend in backends:
+            start = time.perf_counter()
+            size = 0
+            for _, size in read_batches(log, backend=backend):
+                pass
+            elapsed = time.perf_counter() - start
+            print(f"{backend:>8}: {size / elapsed / 2 ** 20:12.1f} MB/s")
+
+
+def write_log(log_path, lines, is_gz):
+    with (gzip.open(log_path, "wt") if is_gz else open(log_path, "w")) as file:
+        file.writelines(lines)
+    return logFileTuple(log_path, None, is_gz)
+
+
+def run_end_to_end(log, report_path, workers, engine):
+    # Запускается в отдельном процессе, чтобы пиковая память считалась
+    # для каждого сценария отдельно.
+    profiler = Profiler()
+    stats = collect_stats(log, workers, engine=engine, profiler=profiler)
+    with profiler.stage("report"):
+        stats = stats.report(err_perc=50, max_entries=1000)
+    with profiler.stage("rendering"):
+        save_report(stats, 1000, report_path)
+    return profiler.summary()
+
+
+def bench_end_to_end(count, urls_num, workers, engine):
+    # Строки лога пишутся в файл сразу из генератора, а прогон идет в
+    # новом процессе (spawn, а не fork), чтобы в пиковую память не
+    # попадала память генератора и главного процесса.
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for is_gz in (False, True):
+            name = "gz" if is_gz else "plain"
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20170630" + (".gz" if is_gz else ""))
+            log = write_log(log_path, generate_lines(count, urls_num), is_gz)
+            report_path = os.path.join(tmp_dir, "report-2017.06.30.html")
+            with context.Pool(1) as pool:
+                results[name] = pool.apply(run_end_to_end, (log, report_path, workers, engine))
+            os.remove(log_path)
+    return results
+
+
+def compare_baseline(results, baseline):
+    for name, result in results.items():
+        line = (f"{name:>8}: {result['lines_per_sec']:12.0f} lines/s "
+                f"{result['mb_per_sec']:8.1f} MB/s {result['peak_rss_mb']:8.1f} MB")
+        if name in baseline:
+            base = baseline[name]
+            line += (f"  speed x{result['lines_per_sec'] / base['lines_per_sec']:.2f}"
+                     f"  memory x{result['peak_rss_mb'] / base['peak_rss_mb']:.2f}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="log_analyzer benchmarks")
+    parser.add_argument("-n", "--lines", type=int, default=200000)
+    parser.add_argument("-u", "--urls", type=int, default=1000)
+    parser.add_argument("--gzip", action="store_true",
+                        help="compare gzip decompression backends")
+    parser.add_argument("--end-to-end", action="store_true",
+                        help="parse, count and save report for plain and gz logs")
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--engine", default="python")
+    parser.add_argument("--baseline", default="bench_baseline.json",
+                        help="results to compare end-to-end benchmark with")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store end-to-end results as the new baseline")
+    args = parser.parse_args()
+
+    if args.end_to_end:
+        results = bench_end_to_end(args.lines, args.urls, args.workers, args.engine)
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+            if baseline.get("lines") != args.lines or baseline.get("urls") != args.urls:
+                print(f"Baseline was made for {baseline.get('lines')} lines and "
+                      f"{baseline.get('urls')} urls")
+        compare_baseline(results, baseline.get("results", {}))
+        if args.save_baseline:
+            with open(args.baseline, "w") as file:
+                json.dump({"lines": args.lines, "urls": args.urls, "results": results}, file, indent=2)
+        return
+
+    lines = list(generate_lines(args.lines, args.urls))
+    if args.gzip:
+        bench_gzip(lines)
+        return
+
+    lines = [line.encode() for line in lines]
+    bench_parser("regex", parse_regex, lines)
+    bench_parser("fast", parse_request, lines)
+
+
+if __name__ == "__main__":
+    main()
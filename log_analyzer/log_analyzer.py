@@ -3,40 +3,121 @@
 
 
 import gzip
+import heapq
 import os
 import argparse
+import pickle
+import time
+import array
+import io
 import collections
-import gzip
+import contextlib
+import functools
+import multiprocessing
 import re
+import resource
+import shutil
+import sqlite3
+import struct
+import subprocess
 import datetime
 import statistics
 import string
+import sys
 import json
 import logging
 import copy
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR":  "./test",
     "LOG_DIR":     "./test",
-    "LOG_FILE":    None
+    "LOG_FILE":    None,
+    "WORKERS":     1,
+    "QUANTILES":   False,
+    "EXACT":       False,
+    "STATS_CACHE": "stats.sqlite3",
+    "CHECKPOINT_INTERVAL": 60,
+    "BACKFILL":    False,
+    "GZIP_BACKEND": "auto",
+    "URL_NORMALIZE": [],
+    "FOLLOW_LOG":  "nginx-access-ui.log",
+    "FOLLOW_WINDOWS": [60, 300, 3600],
+    "FOLLOW_INTERVAL": 10,
+    "ENGINE":      "python",
+    "REPORT_PAGE_SIZE": 0,
+    "PROFILE":     False,
+    "PROGRESS_INTERVAL": 0
 }
 
+CHUNKS_PER_WORKER = 4
+BATCH_SIZE = 4 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+TIME_CACHE_SIZE = 1024
+GZIP_COMMANDS = {
+    "pigz": ["pigz", "-dc"],
+    "zcat": ["gzip", "-dc"],
+}
+SKETCH_SIZE = 256
+QUANTILES = (50, 90, 99)
+EXPORT_COLUMNS = (
+    ("ts",     "q"),
+    ("url",    "i"),
+    ("status", "h"),
+    ("bytes",  "q"),
+    ("time",   "d"),
+)
+EXPORT_CHUNK = 1024 * 1024
+WINDOW_BUCKETS = 12
+FOLLOW_POLL = 0.5
+URL_PLACEHOLDERS = {"numbers": "{id}", "hex": "{hex}"}
+URL_RULES = ("query", ) + tuple(URL_PLACEHOLDERS)
+URL_CACHE_SIZE = 100000
+HEX_SEGMENT = re.compile(r"[0-9a-fA-F]+(-[0-9a-fA-F]+)*")
+HEX_SEGMENT_MIN_LEN = 8
+
+CACHE_TIMEOUT = 60
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    date           TEXT PRIMARY KEY,
+    requests_count INTEGER NOT NULL,
+    requests_time  REAL NOT NULL,
+    err_count      INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS urls (
+    date     TEXT NOT NULL,
+    url      TEXT NOT NULL,
+    count    INTEGER NOT NULL,
+    time_sum REAL NOT NULL,
+    time_max REAL NOT NULL,
+    times    BLOB NOT NULL,
+    PRIMARY KEY (date, url)
+);
+"""
+
 REGEX = re.compile(
     r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|-) ([0-9a-zA-Z]+|-)  (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|-) (\[.+]|-) (\"[A-Z]{3,7} .+ .+\") (\d{3}|-) (\d+|-) (\".+\") (\".+\") (\".+\") (\".+\") (\".+\") (\d+\.\d+|-)", re.DOTALL)
 
+REGEX_BYTES = re.compile(REGEX.pattern.encode(), re.DOTALL)
+
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
 
 
-logFileTuple = collections.namedtuple("log", ["path", "date", "is_gz"])
+logFileTuple = collections.namedtuple("logFileTuple", ["path", "date", "is_gz"])
 
 
-def find_log(path):
-    log_file = None
+def find_logs(path):
+    logs = {}
     files = os.scandir(path)
     file_prefix = "nginx-access-ui.log-"
     for elem in files:
@@ -53,16 +134,120 @@ def find_log(path):
                 date = datetime.datetime.strptime(date, "%Y%m%d").date()
             except:
                 continue
-            if not log_file or date > log_file.date:
-                log_file = logFileTuple(elem.path, date, is_gz)
+            logs.setdefault(date, logFileTuple(elem.path, date, is_gz))
+
+    return [logs[date] for date in sorted(logs)]
+
 
-    return log_file
+def find_log(path):
+    logs = find_logs(path)
+    return logs[-1] if logs else None
 
 
 def report_exists(path, date):
     return os.path.isfile(os.path.join(path, f"report-{date.strftime('%Y.%m.%d')}.html"))
 
 
+def parse_line(line):
+    parsed_line = REGEX.match(line)
+    if parsed_line:
+        return parsed_line.groups()
+
+    logging.debug(f"Could not parse '{line}'")
+    return None
+
+
+def parse_line_fast(line):
+    # Разбираем только то, что нужно для статистики: URL из "$request"
+    # и $request_time. Работаем с байтами строки как есть и декодируем
+    # только URL. Строки, в которых что-то не похоже на ui_short,
+    # отдаем на разбор полному регулярному выражению.
+    start = line.find(b'] "')
+    if start == -1:
+        return None
+    start += 3
+    end = line.find(b'" ', start)
+    if end == -1:
+        return None
+
+    request = line[start:end].split(b" ")
+    if len(request) != 3 or not 3 <= len(request[0]) <= 7:
+        return None
+    if not request[0].isalpha() or not request[0].isupper():
+        return None
+    if not request[1] or not request[2]:
+        return None
+
+    status = line[end + 2:end + 6]
+    if not status[:3].isdigit() or status[3:] != b" ":
+        return None
+
+    end = len(line) - 1 if line.endswith(b"\n") else len(line)
+    time = line[line.rfind(b" ", 0, end) + 1:end]
+    seconds, dot, fraction = time.partition(b".")
+    if not dot or not seconds.isdigit() or not fraction.isdigit():
+        return None
+
+    return request[1].decode("utf-8", errors="replace"), float(time)
+
+
+def parse_request(line):
+    request = parse_line_fast(line)
+    if request:
+        return request
+
+    line = line.rstrip(b"\n")
+    parsed_line = REGEX_BYTES.match(line)
+    if not parsed_line:
+        logging.debug(f"Could not parse '{line.decode('utf-8', errors='replace')}'")
+        return None
+
+    report = parsed_line.groups()
+    try:
+        return report[4].split()[1].decode("utf-8", errors="replace"), float(report[12])
+    except ValueError:
+        logging.debug(f"Could not parse request time in '{line.decode('utf-8', errors='replace')}'")
+        return None
+
+
+# Соседние строки лога обычно имеют одинаковое время, поэтому
+# запоминаем последние разобранные значения.
+@functools.lru_cache(maxsize=TIME_CACHE_SIZE)
+def parse_time_local(value):
+    try:
+        return int(datetime.datetime.strptime(
+            value.decode(), "%d/%b/%Y:%H:%M:%S %z").timestamp())
+    except ValueError:
+        return 0
+
+
+def parse_record(line):
+    # Разбираем поля для выгрузки: время, URL, статус, размер ответа
+    # и время обработки запроса.
+    request = parse_line_fast(line)
+    if request:
+        start = line.find(b" [") + 2
+        end = line.find(b'] "', start)
+        fields = line[line.find(b'" ', end + 3) + 2:].split(b" ", 2)
+        stamp, status, size = line[start:end], fields[0], fields[1]
+    else:
+        parsed_line = REGEX_BYTES.match(line.rstrip(b"\n"))
+        if not parsed_line:
+            return None
+        report = parsed_line.groups()
+        try:
+            request = (report[4].split()[1].decode("utf-8", errors="replace"),
+                       float(report[12]))
+        except ValueError:
+            return None
+        stamp, status, size = report[3][1:-1], report[5], report[6]
+
+    return (parse_time_local(stamp), request[0],
+            int(status) if status.isdigit() else 0,
+            int(size) if size.isdigit() else 0,
+            request[1])
+
+
 def parse_log(log):
     opener = open if not log.is_gz else gzip.open
 
@@ -71,78 +256,1157 @@ def parse_log(log):
             if not line:
                 continue
 
-            line = line.rstrip("\n")
-            parsed_line = REGEX.match(line)
-            if parsed_line:
-                yield parsed_line.groups()
-            else:
-                logging.debug(f"Could not parse '{line}'")
-                yield None
+            yield parse_line(line.rstrip("\n"))
 
 
-def count_stats(log, err_perc):
-    stats = {}
-    requests_count = 0
-    requests_time = 0
-    err_count = 0
+class QuantileSketch(object):
+    """ Оценка квантилей в ограниченной памяти (упрощенный KLL).
+        Значения копятся на уровнях, вес значения на уровне i равен 2**i.
+        Заполненный уровень сортируется и половина его значений
+        переходит на следующий уровень. Пока уровень 0 ни разу не
+        сжимался, квантили считаются точно. При size=None сжатия
+        нет и результат всегда точный.
+    """
 
-    for report in log:
+    def __init__(self, size=SKETCH_SIZE):
+        self.size = size
+        self.levels = [[]]
+        self.offsets = [0]
+        self.count = 0
+
+    def add(self, value):
+        self.levels[0].append(value)
+        self.count += 1
+        if self.size and len(self.levels[0]) >= self.size:
+            self.compress()
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append([])
+                self.offsets.append(0)
+            self.levels[level].extend(items)
+        self.count += other.count
+        if self.size:
+            self.compress()
+
+    def compress(self):
+        for level, items in enumerate(self.levels):
+            if len(items) < self.size:
+                continue
+
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+                self.offsets.append(0)
+            items.sort()
+            # При нечетной длине одно значение остается на уровне,
+            # чтобы не потерять его вес.
+            leftover = [items.pop()] if len(items) % 2 else []
+            # Каждое сжатие уровня берет то четные, то нечетные
+            # позиции, иначе оценки квантилей смещаются в одну сторону.
+            offset = self.offsets[level]
+            self.offsets[level] ^= 1
+            self.levels[level + 1].extend(items[offset::2])
+            self.levels[level] = leftover
+
+    def copy(self):
+        sketch = QuantileSketch(self.size)
+        sketch.levels = [list(items) for items in self.levels]
+        sketch.offsets = list(self.offsets)
+        sketch.count = self.count
+        return sketch
+
+    def to_bytes(self):
+        header = struct.pack("<II", self.size or 0, len(self.levels))
+        lengths = array.array("I", (len(items) for items in self.levels))
+        values = array.array("d", (value for items in self.levels for value in items))
+        return header + lengths.tobytes() + values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, count):
+        size, levels_num = struct.unpack_from("<II", data)
+        offset = struct.calcsize("<II")
+        lengths = array.array("I")
+        lengths.frombytes(data[offset:offset + levels_num * lengths.itemsize])
+        values = array.array("d")
+        values.frombytes(data[offset + levels_num * lengths.itemsize:])
+
+        sketch = cls(size or None)
+        sketch.count = count
+        sketch.levels = []
+        pos = 0
+        for length in lengths:
+            sketch.levels.append(values[pos:pos + length].tolist())
+            pos += length
+        sketch.offsets = [0] * len(sketch.levels)
+        return sketch
+
+    def is_exact(self):
+        return len(self.levels) == 1
+
+    def median(self):
+        if self.is_exact():
+            return statistics.median(self.levels[0])
+        return self.quantile(50)
+
+    def quantile(self, perc):
+        if self.is_exact():
+            values = sorted(self.levels[0])
+            rank = max(0, -(-len(values) * perc // 100) - 1)
+            return values[rank]
+
+        values = sorted(
+            (value, 1 << level)
+            for level, items in enumerate(self.levels)
+            for value in items
+        )
+        weight = sum(w for _, w in values)
+        rank = weight * perc / 100
+        acc = 0
+        for value, w in values:
+            acc += w
+            if acc >= rank:
+                return value
+        return values[-1][0]
+
+
+class UrlNormalizer(object):
+    """ Приводит URL к общему виду, чтобы запросы к одному обработчику
+        попадали в одну строку отчета. Правила:
+        * query - отрезать строку запроса и фрагмент;
+        * numbers - заменить числовые сегменты пути на {id};
+        * hex - заменить шестнадцатеричные сегменты и UUID на {hex}.
+        Результаты запоминаются и интернируются, чтобы одинаковые
+        URL занимали память один раз.
+    """
+
+    def __init__(self, rules):
+        unknown = set(rules) - set(URL_RULES)
+        if unknown:
+            raise ValueError(f"Unknown URL normalization rules: {sorted(unknown)}")
+
+        self.rules = tuple(rules)
+        self.strip_query = "query" in rules
+        self.numbers = "numbers" in rules
+        self.hex = "hex" in rules
+        self.cache = {}
+
+    def __getstate__(self):
+        return {"rules": self.rules}
+
+    def __setstate__(self, state):
+        self.__init__(state["rules"])
+
+    def __call__(self, url):
+        normalized = self.cache.get(url)
+        if normalized is None:
+            normalized = sys.intern(self.normalize(url))
+            if len(self.cache) >= URL_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[url] = normalized
+        return normalized
+
+    def normalize(self, url):
+        end = len(url)
+        for sep in "?#":
+            pos = url.find(sep)
+            if pos != -1 and pos < end:
+                end = pos
+        path, tail = url[:end], url[end:]
+        if self.strip_query:
+            tail = ""
+
+        if self.numbers or self.hex:
+            segments = path.split("/")
+            for i, segment in enumerate(segments):
+                if self.numbers and segment.isdigit():
+                    segments[i] = URL_PLACEHOLDERS["numbers"]
+                elif (self.hex and len(segment) >= HEX_SEGMENT_MIN_LEN
+                        and HEX_SEGMENT.fullmatch(segment)
+                        and any(c.isdigit() for c in segment)):
+                    segments[i] = URL_PLACEHOLDERS["hex"]
+            path = "/".join(segments)
+
+        return path + tail
+
+
+def report_order(url_stat):
+    return round(url_stat["time_sum"], 3)
+
+
+class LogStats(object):
+    def __init__(self, exact=False, normalize=()):
+        self.exact = exact
+        self.sketch_size = None if exact else SKETCH_SIZE
+        self.normalize = tuple(normalize)
+        self.normalizer = UrlNormalizer(normalize) if normalize else None
+        self.urls = {}
+        self.requests_count = 0
+        self.requests_time = 0
+        self.err_count = 0
+
+    def add(self, report):
         if not report:
-            err_count += 1
-            continue
+            self.err_count += 1
+            return
 
         url = report[4]
         url = url.split()[1]
         time = float(report[12])
+        self.add_request(url, time)
 
-        requests_count += 1
-        requests_time += time
+    def options(self):
+        return {"exact": self.exact, "normalize": self.normalize}
 
-        if not url in stats:
-            stats[url] = {"url":      url,
-                          "count":    1,
-                          "time_sum": time,
-                          "time_max": time,
-                          "time_med": [time]}
+    def copy(self):
+        stats = LogStats(**self.options())
+        stats.requests_count = self.requests_count
+        stats.requests_time = self.requests_time
+        stats.err_count = self.err_count
+        stats.urls = {url: dict(url_stat, time_med=url_stat["time_med"].copy())
+                      for url, url_stat in self.urls.items()}
+        return stats
+
+    def add_request(self, url, time):
+        self.requests_count += 1
+        self.requests_time += time
+        if self.normalizer:
+            url = self.normalizer(url)
+
+        url_stat = self.urls.get(url)
+        if not url_stat:
+            url_stat = {"url":      url,
+                        "count":    1,
+                        "time_sum": time,
+                        "time_max": time,
+                        "time_med": QuantileSketch(self.sketch_size)}
+            self.urls[url] = url_stat
         else:
-            stats[url]["count"] += 1
-            stats[url]["time_sum"] += time
-            if time > stats[url]["time_max"]:
-                stats[url]["time_max"] = time
-            stats[url]["time_med"].append(time)
-
-    actual_err_perc = 100 / ((err_count + requests_count) / err_count)
-    if actual_err_perc >= err_perc:
-        msg = f"There is more than {actual_err_perc}% of errors while parsing the log"
-        logging.info(msg)
+            url_stat["count"] += 1
+            url_stat["time_sum"] += time
+            if time > url_stat["time_max"]:
+                url_stat["time_max"] = time
+        url_stat["time_med"].add(time)
+
+    def add_lines(self, lines):
+        for line in lines:
+            request = parse_request(line)
+            if request:
+                self.add_request(*request)
+            else:
+                self.err_count += 1
+
+    def merge(self, other):
+        self.requests_count += other.requests_count
+        self.requests_time += other.requests_time
+        self.err_count += other.err_count
+
+        for url, other_stat in other.urls.items():
+            if self.normalizer:
+                url = self.normalizer(url)
+                other_stat["url"] = url
+
+            url_stat = self.urls.get(url)
+            if not url_stat:
+                self.urls[url] = other_stat
+                continue
+
+            url_stat["count"] += other_stat["count"]
+            url_stat["time_sum"] += other_stat["time_sum"]
+            if other_stat["time_max"] > url_stat["time_max"]:
+                url_stat["time_max"] = other_stat["time_max"]
+            url_stat["time_med"].merge(other_stat["time_med"])
+
+    def report(self, err_perc, quantiles=False, max_entries=None):
+        lines_count = self.err_count + self.requests_count
+        actual_err_perc = 100 * self.err_count / lines_count if lines_count else 0
+        if actual_err_perc >= err_perc:
+            msg = f"There is more than {actual_err_perc}% of errors while parsing the log"
+            logging.info(msg)
+            return
+
+        url_stats = self.urls.values()
+        if max_entries is not None:
+            # Остальные поля считаем только для URL, которые попадут в отчет.
+            url_stats = heapq.nlargest(max_entries, url_stats, key=report_order)
+
+        stats = {}
+        for url_stat in url_stats:
+            url_stat = dict(url_stat)
+            url_stat["time_sum"] = round(url_stat["time_sum"], 3)
+            url_stat["count_perc"] = round(
+                100 / (self.requests_count / url_stat["count"]), 3)
+
+            if url_stat["time_sum"] > 0:
+                url_stat["time_perc"] = round(
+                    100 / (self.requests_time / url_stat["time_sum"]), 3)
+            else:
+                url_stat["time_perc"] = 0
+
+            url_stat["time_avg"] = round(
+                url_stat["time_sum"] / url_stat["count"], 3)
+            sketch = url_stat["time_med"]
+            url_stat["time_med"] = round(sketch.median(), 3)
+            if quantiles:
+                for perc in QUANTILES:
+                    url_stat[f"time_p{perc}"] = round(sketch.quantile(perc), 3)
+            stats[url_stat["url"]] = url_stat
+
+        return stats
+
+
+class VectorStats(object):
+    """ Статистика по URL, которая копит номера URL и времена запросов
+        в массивах numpy и считает количество, сумму, максимум и медиану
+        по URL векторно: через np.bincount и сортировку по номеру URL.
+        Суммы считаются в порядке строк лога, а медианы точно, поэтому
+        отчет совпадает с отчетом LogStats(exact=True).
+    """
+
+    def __init__(self, normalize=()):
+        if np is None:
+            raise ImportError("numpy is required for the numpy engine")
+
+        self.normalize = tuple(normalize)
+        self.normalizer = UrlNormalizer(normalize) if normalize else None
+        self.url_ids = {}
+        self.ids = []
+        self.times = []
+        self.requests_count = 0
+        self.requests_time = 0
+        self.err_count = 0
+
+    def options(self):
+        return {"normalize": self.normalize, "engine": "numpy"}
+
+    def url_id(self, url):
+        if self.normalizer:
+            url = self.normalizer(url)
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.url_ids)
+        return url_id
+
+    def add_arrays(self, ids, times):
+        if not len(ids):
+            return
+
+        self.ids.append(ids)
+        self.times.append(times)
+        self.requests_count += len(ids)
+        # cumsum складывает по порядку, как и LogStats.add_request.
+        self.requests_time = float(np.cumsum(np.concatenate(([self.requests_time], times)))[-1])
+
+    def add_lines(self, lines):
+        ids = array.array("i")
+        times = array.array("d")
+        for line in lines:
+            request = parse_request(line)
+            if request:
+                ids.append(self.url_id(request[0]))
+                times.append(request[1])
+            else:
+                self.err_count += 1
+
+        self.add_arrays(np.frombuffer(ids, dtype=np.intc), np.frombuffer(times, dtype=np.float64))
+
+    def add_columns(self, ids, times, urls):
+        mapping = np.array([self.url_id(url) for url in urls], dtype=np.intc)
+        remap = not np.array_equal(mapping, np.arange(len(urls)))
+        for start in range(0, len(ids), EXPORT_CHUNK):
+            chunk_ids = ids[start:start + EXPORT_CHUNK]
+            chunk_ids = mapping[chunk_ids] if remap else np.asarray(chunk_ids, dtype=np.intc)
+            self.add_arrays(chunk_ids, np.asarray(times[start:start + EXPORT_CHUNK], dtype=np.float64))
+
+    def merge(self, other):
+        requests_time = self.requests_time + other.requests_time
+        err_count = self.err_count + other.err_count
+        self.add_columns(np.concatenate(other.ids) if other.ids else np.empty(0, np.intc),
+                         np.concatenate(other.times) if other.times else np.empty(0),
+                         list(other.url_ids))
+        self.requests_time = requests_time
+        self.err_count = err_count
+
+    def to_log_stats(self, max_entries=None, exact=True):
+        stats = LogStats(exact)
+        stats.requests_count = self.requests_count
+        stats.requests_time = self.requests_time
+        stats.err_count = self.err_count
+        if not self.ids:
+            return stats
+
+        urls = list(self.url_ids)
+        ids = np.concatenate(self.ids)
+        times = np.concatenate(self.times)
+        counts = np.bincount(ids, minlength=len(urls))
+        sums = np.bincount(ids, weights=times, minlength=len(urls))
+
+        selected = np.flatnonzero(counts).tolist()
+        if max_entries is not None:
+            # Порядок и ключ те же, что в LogStats.report, поэтому при
+            # равных суммах выбираются те же URL.
+            keys = [round(value, 3) for value in sums.tolist()]
+            selected = sorted(heapq.nlargest(max_entries, selected, key=keys.__getitem__))
+            mask = np.isin(ids, selected)
+            ids, times = ids[mask], times[mask]
+
+        order = np.lexsort((times, ids))
+        times = times[order]
+        start = 0
+        for url_id in selected:
+            count = int(counts[url_id])
+            values = times[start:start + count].tolist()
+            start += count
+
+            sketch = QuantileSketch(stats.sketch_size)
+            if exact:
+                sketch.levels[0] = values
+                sketch.count = count
+            else:
+                for value in values:
+                    sketch.add(value)
+
+            url = urls[url_id]
+            stats.urls[url] = {"url":      url,
+                               "count":    count,
+                               "time_sum": float(sums[url_id]),
+                               "time_max": values[-1],
+                               "time_med": sketch}
+        return stats
+
+    def report(self, err_perc, quantiles=False, max_entries=None):
+        return self.to_log_stats(max_entries).report(err_perc, quantiles, max_entries)
+
+
+def make_stats(exact=False, normalize=(), engine="python"):
+    if engine == "numpy":
+        return VectorStats(normalize)
+    return LogStats(exact, normalize)
+
+
+def count_stats(log, err_perc, exact=False, quantiles=False, normalize=()):
+    stats = LogStats(exact, normalize)
+    for report in log:
+        stats.add(report)
+
+    return stats.report(err_perc, quantiles)
+
+
+class GzipBlockReader(io.RawIOBase):
+    """ Распаковывает gzip большими блоками через zlib. Поверх него
+        работает io.BufferedReader, который делит данные на строки.
+        Поддерживает файлы из нескольких gzip-потоков.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.started = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                self.started = False
+            else:
+                data = self.decompressor.unconsumed_tail
+
+            if not data:
+                data = self.file.read(BLOCK_SIZE)
+                if not data:
+                    if self.started:
+                        raise EOFError("Compressed file ended before the "
+                                       "end-of-stream marker was reached")
+                    return 0
+
+            if not self.started and not data.strip(b"\0"):
+                # Нули в конце файла после последнего потока.
+                continue
+
+            self.started = True
+            chunk = self.decompressor.decompress(data, len(buf))
+            if chunk:
+                buf[:len(chunk)] = chunk
+                return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+@contextlib.contextmanager
+def open_gzip_pipe(command, path):
+    process = subprocess.Popen(command + [path], stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+    finished = False
+    try:
+        yield process.stdout
+        # Конец потока означает, что программа закрыла вывод. Если
+        # данные еще остались, лог дочитан не до конца, и код возврата
+        # не важен.
+        finished = not process.stdout.read(1)
+    finally:
+        if not finished:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+
+    if finished and returncode:
+        raise OSError(f"{command[0]} exited with code {returncode} on {path}")
+
+
+def gzip_backend(backend="auto"):
+    if backend != "auto":
+        return backend
+
+    # Внешняя программа распаковывает лог в отдельном процессе, пока
+    # этот разбирает строки. На одном ядре это медленнее распаковки
+    # блоками через zlib.
+    if shutil.which(GZIP_COMMANDS["pigz"][0]):
+        return "pigz"
+    if shutil.which(GZIP_COMMANDS["zcat"][0]) and (os.cpu_count() or 1) > 1:
+        return "zcat"
+    return "zlib"
+
+
+def open_log(log, backend="auto"):
+    if not log.is_gz:
+        return open(log.path, "rb")
+
+    backend = gzip_backend(backend)
+    if backend in GZIP_COMMANDS:
+        return open_gzip_pipe(GZIP_COMMANDS[backend], log.path)
+    if backend == "zlib":
+        return io.BufferedReader(GzipBlockReader(log.path), buffer_size=BLOCK_SIZE)
+    return gzip.open(log.path, "rb")
+
+
+def skip_bytes(file, offset):
+    if not offset:
         return
 
-    for url_stat in stats.values():
-        url_stat["time_sum"] = round(url_stat["time_sum"], 3)
-        url_stat["count_perc"] = round(
-            100 / (requests_count / url_stat["count"]), 3)
+    try:
+        file.seek(offset)
+    except (OSError, io.UnsupportedOperation):
+        while offset:
+            data = file.read(min(offset, BLOCK_SIZE))
+            if not data:
+                break
+            offset -= len(data)
+
+
+class Profiler(object):
+    """ Собирает время работы этапов обработки лога, число строк и
+        байт, пиковое потребление памяти и долю нераспознанных строк.
+        Если задан progress_interval, раз в столько секунд пишет в
+        лог, сколько уже обработано.
+
+        Строка разбирается и сразу учитывается в статистике своего
+        URL, поэтому этап parsing включает и то, и другое.
+    """
+
+    def __init__(self, progress_interval=0):
+        self.progress_interval = progress_interval
+        self.stages = collections.defaultdict(float)
+        self.started = self.reported = time.perf_counter()
+        self.lines = 0
+        self.size = 0
+        self.err_count = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def iterate(self, iterable, name):
+        # Время получения каждого элемента учитывается в этапе name.
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def progress(self, size, lines):
+        self.size = size
+        self.lines += lines
+        now = time.perf_counter()
+        if self.progress_interval and now - self.reported >= self.progress_interval:
+            self.reported = now
+            elapsed = now - self.started
+            logging.info(f"Processed {self.size / 2 ** 20:.1f} MB, "
+                         f"{self.size / 2 ** 20 / elapsed:.1f} MB/s, "
+                         f"{self.lines} lines, {self.lines / elapsed:.0f} lines/s")
+
+    def done(self, stats):
+        self.lines = stats.requests_count + stats.err_count
+        self.err_count = stats.err_count
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # ru_maxrss в Linux в килобайтах, в macOS в байтах.
+        peak_rss = peak_rss * (1 if sys.platform == "darwin" else 1024)
+        return {
+            "stages": {name: round(value, 3) for name, value in self.stages.items()},
+            "total": round(elapsed, 3),
+            "lines": self.lines,
+            "bytes": self.size,
+            "lines_per_sec": round(self.lines / elapsed) if elapsed else 0,
+            "mb_per_sec": round(self.size / 2 ** 20 / elapsed, 3) if elapsed else 0,
+            "peak_rss_mb": round(peak_rss / 2 ** 20, 1),
+            "err_perc": round(100 * self.err_count / self.lines, 3) if self.lines else 0,
+        }
+
 
-        if url_stat["time_sum"] > 0:
-            url_stat["time_perc"] = round(
-                100 / (requests_time / url_stat["time_sum"]), 3)
+def collect_stats(log, workers=1, exact=False, checkpoint=None, backend="auto", normalize=(),
+                  engine="python", profiler=None):
+    stats, offset = None, 0
+    if checkpoint:
+        stats, offset = checkpoint.load()
+    if not stats:
+        stats, offset = make_stats(exact, normalize, engine), 0
+    if not profiler:
+        profiler = Profiler()
+
+    if workers > 1:
+        stats = collect_stats_parallel(log, workers, stats=stats, offset=offset,
+                                       checkpoint=checkpoint, backend=backend,
+                                       profiler=profiler)
+        profiler.done(stats)
+        return stats
+
+    for batch, offset in profiler.iterate(read_batches(log, offset, backend), "decompression"):
+        with profiler.stage("parsing"):
+            stats.add_lines(batch)
+        profiler.progress(offset, len(batch))
+        if checkpoint:
+            checkpoint.save(stats, offset)
+
+    profiler.done(stats)
+    return stats
+
+
+class Checkpoint(object):
+    """ Периодически сохраняет частично посчитанную статистику и
+        смещение в распакованном логе, с которого нужно продолжить
+        разбор. Сохраненное состояние используется, только если
+        лог с тех пор не менялся.
+    """
+
+    def __init__(self, path, log, options, interval):
+        self.path = path
+        self.interval = interval
+        stat = os.stat(log.path)
+        self.key = (os.path.realpath(log.path), stat.st_size, stat.st_mtime_ns, options)
+        self.saved = time.monotonic()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                key, stats, offset = pickle.load(file)
+        except FileNotFoundError:
+            return None, 0
+        except Exception as err:
+            logging.warning(f"Could not load checkpoint {self.path}: {err}")
+            return None, 0
+
+        if key != self.key:
+            logging.info(f"Checkpoint {self.path} belongs to another log, ignore it")
+            return None, 0
+
+        logging.info(f"Resume parsing from offset {offset}")
+        return stats, offset
+
+    def save(self, stats, offset, force=False):
+        if not force and time.monotonic() - self.saved < self.interval:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump((self.key, stats, offset), file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.saved = time.monotonic()
+
+    def remove(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+def save_stats_cache(path, date, stats):
+    if isinstance(stats, VectorStats):
+        stats = stats.to_log_stats(exact=False)
+
+    with contextlib.closing(sqlite3.connect(path, timeout=CACHE_TIMEOUT)) as db, db:
+        db.executescript(CACHE_SCHEMA)
+        db.execute("DELETE FROM urls WHERE date = ?", (date.isoformat(), ))
+        db.execute(
+            "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?)",
+            (date.isoformat(), stats.requests_count, stats.requests_time, stats.err_count))
+        db.executemany(
+            "INSERT INTO urls VALUES (?, ?, ?, ?, ?, ?)",
+            ((date.isoformat(), url, url_stat["count"], url_stat["time_sum"],
+              url_stat["time_max"], url_stat["time_med"].to_bytes())
+             for url, url_stat in stats.urls.items()))
+
+
+def load_stats_cache(path, date_from, date_to, exact=False, normalize=()):
+    stats = LogStats(exact, normalize)
+    dates = []
+    if not os.path.isfile(path):
+        return stats, dates
+
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        db.executescript(CACHE_SCHEMA)
+        logs = db.execute(
+            "SELECT * FROM logs WHERE date BETWEEN ? AND ? ORDER BY date",
+            (date_from.isoformat(), date_to.isoformat())).fetchall()
+
+        for date, requests_count, requests_time, err_count in logs:
+            day_stats = LogStats(exact)
+            day_stats.requests_count = requests_count
+            day_stats.requests_time = requests_time
+            day_stats.err_count = err_count
+
+            rows = db.execute(
+                "SELECT url, count, time_sum, time_max, times FROM urls WHERE date = ?",
+                (date, ))
+            for url, count, time_sum, time_max, times in rows:
+                day_stats.urls[url] = {"url":      url,
+                                       "count":    count,
+                                       "time_sum": time_sum,
+                                       "time_max": time_max,
+                                       "time_med": QuantileSketch.from_bytes(times, count)}
+
+            stats.merge(day_stats)
+            dates.append(datetime.date.fromisoformat(date))
+
+    return stats, dates
+
+
+def split_log(path, chunks_num, start=0):
+    size = os.path.getsize(path)
+    bounds = [start]
+    with open(path, "rb") as file:
+        for i in range(1, chunks_num):
+            pos = start + (size - start) * i // chunks_num
+            if pos <= bounds[-1]:
+                continue
+
+            # Сдвигаем границу на начало следующей строки. Строка
+            # принадлежит тому куску, в котором она начинается.
+            file.seek(pos)
+            file.readline()
+            pos = file.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+
+    if size > start:
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_chunk(path, start, end):
+    with open(path, "rb") as file:
+        file.seek(start)
+        pos = start
+        for line in file:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+
+def count_chunk_stats(path, start, end, options):
+    stats = make_stats(**options)
+    stats.add_lines(read_chunk(path, start, end))
+    return stats
+
+
+def count_lines_stats(lines, options):
+    stats = make_stats(**options)
+    stats.add_lines(lines)
+    return stats
+
+
+def read_batches(log, offset=0, backend="auto"):
+    with open_log(log, backend) as file:
+        skip_bytes(file, offset)
+        while True:
+            batch = file.readlines(BATCH_SIZE)
+            if not batch:
+                break
+            offset += sum(map(len, batch))
+            yield batch, offset
+
+
+def collect_stats_parallel(log, workers, exact=False, stats=None, offset=0, checkpoint=None,
+                           backend="auto", profiler=None):
+    if not stats:
+        stats = LogStats(exact)
+    if not profiler:
+        profiler = Profiler()
+    options = stats.options()
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        if not log.is_gz:
+            chunks = split_log(log.path, workers * CHUNKS_PER_WORKER, offset)
+            tasks = ((count_chunk_stats, (log.path, start, end, options), end)
+                     for start, end in chunks)
         else:
-            url_stat["time_perc"] = 0
+            # В gzip нельзя перейти к произвольному смещению, поэтому
+            # распаковываем поток здесь, а разбор строк и подсчет
+            # статистики раздаем пачками по процессам.
+            tasks = ((count_lines_stats, (batch, options), end)
+                     for batch, end in read_batches(log, offset, backend))
 
-        url_stat["time_avg"] = round(
-            url_stat["time_sum"] / url_stat["count"], 3)
-        url_stat["time_med"] = round(statistics.median(url_stat["time_med"]), 3)
+        # Ограничиваем число задач в работе, чтобы распакованные
+        # пачки строк не копились в памяти. Результаты объединяются
+        # в порядке постановки задач, поэтому все до смещения end
+        # уже учтено и его можно сохранять в контрольную точку.
+        pending = collections.deque()
+        for func, args, end in profiler.iterate(tasks, "decompression"):
+            pending.append((pool.apply_async(func, args), end))
+            if len(pending) >= workers * 2:
+                merge_result(stats, pending.popleft(), checkpoint, profiler)
+
+        while pending:
+            merge_result(stats, pending.popleft(), checkpoint, profiler)
 
     return stats
 
 
-def save_report(log, max_entries, report_path):
+def merge_result(stats, task, checkpoint, profiler):
+    result, end = task
+    with profiler.stage("waiting"):
+        result = result.get()
+    with profiler.stage("aggregation"):
+        stats.merge(result)
+    profiler.progress(end, result.requests_count + result.err_count)
+    if checkpoint:
+        checkpoint.save(stats, end)
+
+
+def count_stats_parallel(log, workers, err_perc, exact=False, quantiles=False):
+    return collect_stats_parallel(log, workers, exact).report(err_perc, quantiles)
+
+
+class LogTail(object):
+    """ Читает строки, дописываемые в конец лога. Если лог
+        переименовали и на его месте создали новый файл, дочитывает
+        старый и переходит на новый. Если лог обрезали, читает его
+        с начала. Неполная последняя строка ждет продолжения.
+    """
+
+    def __init__(self, path, from_end=True):
+        self.path = path
+        self.from_end = from_end
+        self.file = None
+        self.inode = None
+        self.rest = b""
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def open(self):
+        try:
+            self.file = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        if self.from_end:
+            self.file.seek(0, os.SEEK_END)
+        # После ротации новый файл читается с начала.
+        self.from_end = False
+        return True
+
+    def read_lines(self, max_size=BATCH_SIZE):
+        if not self.file and not self.open():
+            return []
+
+        data = self.rest + self.file.read(max_size)
+        if len(data) == len(self.rest):
+            self.check_rotation()
+
+        end = data.rfind(b"\n") + 1
+        self.rest = data[end:]
+        return data[:end].splitlines(keepends=True)
+
+    def check_rotation(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        if stat.st_ino != self.inode:
+            logging.info(f"{self.path} was rotated")
+            self.close()
+            self.rest = b""
+        elif stat.st_size < self.file.tell():
+            logging.info(f"{self.path} was truncated")
+            self.file.seek(0)
+            self.rest = b""
+
+
+class RollingStats(object):
+    """ Статистика за последние window секунд. Окно делится на
+        WINDOW_BUCKETS корзин, каждая корзина хранит статистику за свой
+        отрезок времени. Устаревшие корзины выбрасываются, поэтому
+        память не растет со временем.
+    """
+
+    def __init__(self, window, options):
+        self.window = window
+        self.bucket_len = window / WINDOW_BUCKETS
+        self.options = options
+        self.buckets = collections.deque()
+
+    def bucket(self, now):
+        start = now - now % self.bucket_len
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append((start, LogStats(**self.options)))
+        self.expire(now)
+        return self.buckets[-1][1]
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] + self.bucket_len <= now - self.window:
+            self.buckets.popleft()
+
+    def add(self, request, now):
+        bucket = self.bucket(now)
+        if request:
+            bucket.add_request(*request)
+        else:
+            bucket.err_count += 1
+
+    def stats(self, now):
+        self.expire(now)
+        stats = LogStats(**self.options)
+        for _, bucket in self.buckets:
+            stats.merge(bucket.copy())
+        return stats
+
+
+def window_name(window):
+    for name, seconds in (("h", 3600), ("m", 60)):
+        if window % seconds == 0:
+            return f"{window // seconds}{name}"
+    return f"{window}s"
+
+
+def follow(config, report_dir):
+    template = load_template()
+    options = LogStats(config["EXACT"], config["URL_NORMALIZE"]).options()
+    windows = [RollingStats(window, options) for window in config["FOLLOW_WINDOWS"]]
+    tail = LogTail(os.path.join(os.path.realpath(config["LOG_DIR"]), config["FOLLOW_LOG"]))
+    logging.info(f'Follow {tail.path}')
+
+    render_time = time.monotonic() + config["FOLLOW_INTERVAL"]
+    try:
+        while True:
+            lines = tail.read_lines()
+            now = time.monotonic()
+            for line in lines:
+                request = parse_request(line)
+                for window in windows:
+                    window.add(request, now)
+
+            if now >= render_time:
+                for window in windows:
+                    stats = window.stats(now).report(
+                        err_perc=50, quantiles=config["QUANTILES"],
+                        max_entries=config["REPORT_SIZE"])
+                    if stats is not None:
+                        report_file = os.path.join(
+                            report_dir, f"report-live-{window_name(window.window)}.html")
+                        save_report(stats, config["REPORT_SIZE"], report_file, template,
+                                    config["REPORT_PAGE_SIZE"])
+                render_time = now + config["FOLLOW_INTERVAL"]
+
+            if not lines:
+                time.sleep(FOLLOW_POLL)
+    finally:
+        tail.close()
+
+
+class ColumnExporter(object):
+    """ Записывает разобранные строки лога в отдельные файлы по
+        колонкам: ts.bin, url.bin, status.bin, bytes.bin, time.bin.
+        Вместо URL пишется его номер в словаре urls.json. Описание
+        колонок, число строк, размер и время изменения лога хранятся
+        в meta.json. Он пишется последним и только после успешной
+        выгрузки, поэтому выгрузка без него считается неполной. Файлы
+        можно отобразить в память через numpy.memmap (см. load_export).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # Старое описание не должно остаться рядом с перезаписанными
+        # колонками, если новая выгрузка прервется.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(path, "meta.json"))
+        self.files = {name: open(os.path.join(path, f"{name}.bin"), "wb")
+                      for name, _ in EXPORT_COLUMNS}
+        self.urls = {}
+        self.count = 0
+        self.err_count = 0
+
+    def add_lines(self, lines):
+        columns = {name: array.array(typecode) for name, typecode in EXPORT_COLUMNS}
+        ts, url, status, size, time = (columns[name] for name, _ in EXPORT_COLUMNS)
+        for line in lines:
+            record = parse_record(line)
+            if not record:
+                self.err_count += 1
+                continue
+
+            url_id = self.urls.get(record[1])
+            if url_id is None:
+                url_id = self.urls[record[1]] = len(self.urls)
+            ts.append(record[0])
+            url.append(url_id)
+            status.append(record[2])
+            size.append(record[3])
+            time.append(record[4])
+
+        self.count += len(ts)
+        for name, column in columns.items():
+            column.tofile(self.files[name])
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+    def save_meta(self, log):
+        with open(os.path.join(self.path, "urls.json"), "w") as file:
+            json.dump(list(self.urls), file)
+
+        # Тип колонки записываем в формате numpy: порядок байт, вид и размер.
+        byteorder = "<" if sys.byteorder == "little" else ">"
+        columns = {}
+        for name, typecode in EXPORT_COLUMNS:
+            kind = "f" if typecode == "d" else "i"
+            columns[name] = f"{byteorder}{kind}{array.array(typecode).itemsize}"
+
+        stat = os.stat(log.path)
+        meta = {"count": self.count, "errors": self.err_count, "columns": columns,
+                "log_size": stat.st_size, "log_mtime": stat.st_mtime_ns}
+        meta_path = os.path.join(self.path, "meta.json")
+        with open(meta_path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+
+def export_log(log, path, backend="auto"):
+    exporter = ColumnExporter(path)
+    try:
+        for batch, _ in read_batches(log, backend=backend):
+            exporter.add_lines(batch)
+    finally:
+        exporter.close()
+    exporter.save_meta(log)
+    return exporter.count
+
+
+def export_matches(path, log):
+    """ Проверяет, что в path есть законченная выгрузка лога log и
+        лог с тех пор не менялся.
+    """
+    try:
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    stat = os.stat(log.path)
+    return (meta.get("log_size"), meta.get("log_mtime")) == (stat.st_size, stat.st_mtime_ns)
+
+
+def load_export(path):
+    if np is None:
+        raise ImportError("numpy is required to load exported logs")
+
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    with open(os.path.join(path, "urls.json")) as file:
+        urls = json.load(file)
+
+    columns = {}
+    for name, dtype in meta["columns"].items():
+        if meta["count"]:
+            columns[name] = np.memmap(os.path.join(path, f"{name}.bin"),
+                                      dtype=dtype, mode="r", shape=(meta["count"], ))
+        else:
+            columns[name] = np.empty(0, dtype=dtype)
+    return columns, urls, meta
+
+
+def load_export_stats(path, normalize=()):
+    columns, urls, meta = load_export(path)
+    stats = VectorStats(normalize)
+    stats.add_columns(columns["url"], columns["time"], urls)
+    stats.err_count = meta["errors"]
+    return stats
+
+
+def load_template():
     with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "template.html")) as file:
-        log = sorted(log.values(),
-                     key=lambda value: value["time_sum"],
-                     reverse=True)[:max_entries]
-        report = string.Template(str(file.read())).safe_substitute(table_json=log)
-        with open(report_path, "w") as report_file:
-            report_file.write(report)
+        return file.read()
+
+
+def write_json_rows(file, rows):
+    # Пишем строки таблицы по одной, не собирая весь JSON в памяти.
+    # "</" экранируем, чтобы URL не мог закрыть тег <script>.
+    file.write("[")
+    for i, row in enumerate(rows):
+        if i:
+            file.write(",\n")
+        file.write(json.dumps(row).replace("</", "<\\/"))
+    file.write("]")
+
+
+def save_report(log, max_entries, report_path, template=None, page_size=0):
+    if template is None:
+        template = load_template()
+
+    log = heapq.nlargest(max_entries, log.values(), key=report_order)
+    pages = []
+    if page_size and len(log) > page_size:
+        # Первая страница встраивается в отчет, остальные браузер
+        # подгружает отдельными JSON-файлами по мере прокрутки.
+        pages_dir = os.path.splitext(report_path)[0] + ".pages"
+        os.makedirs(pages_dir, exist_ok=True)
+        for start in range(page_size, len(log), page_size):
+            page_name = f"{start // page_size}.json"
+            with open(os.path.join(pages_dir, page_name), "w") as page_file:
+                write_json_rows(page_file, log[start:start + page_size])
+            pages.append(f"{os.path.basename(pages_dir)}/{page_name}")
+        log = log[:page_size]
+
+    head, tail = template.split("$table_json", 1)
+    tail = string.Template(tail).safe_substitute(table_pages=json.dumps(pages or None))
+
+    tmp_path = report_path + ".tmp"
+    with open(tmp_path, "w") as report_file:
+        report_file.write(head)
+        write_json_rows(report_file, log)
+        report_file.write(tail)
+    os.replace(tmp_path, report_path)
 
 
 def read_config(config, new_config):
@@ -151,11 +1415,107 @@ def read_config(config, new_config):
         return config
 
 
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y%m%d").date()
+
+
+def build_range_report(config, report_dir, date_from, date_to):
+    cache_path = os.path.join(report_dir, config["STATS_CACHE"])
+    stats, dates = load_stats_cache(cache_path, date_from, date_to,
+                                    config["EXACT"], config["URL_NORMALIZE"])
+    if not dates:
+        logging.info(f'There are no cached stats from {date_from} to {date_to}')
+        return
+
+    missing = (date_to - date_from).days + 1 - len(dates)
+    if missing:
+        logging.warning(f'Stats for {missing} days from {date_from} to {date_to} are not cached')
+
+    stats = stats.report(err_perc=50, quantiles=config["QUANTILES"],
+                         max_entries=config["REPORT_SIZE"])
+    if stats:
+        report_file = os.path.join(
+            report_dir,
+            f"report-{date_from.strftime('%Y.%m.%d')}-{date_to.strftime('%Y.%m.%d')}.html")
+        save_report(stats, config["REPORT_SIZE"], report_file,
+                    page_size=config["REPORT_PAGE_SIZE"])
+
+
+def process_log(log, config, report_dir, template=None, workers=1, profiler=None):
+    if not profiler:
+        profiler = Profiler()
+
+    report_date = log.date.strftime('%Y.%m.%d')
+    checkpoint = None
+    export_path = os.path.join(report_dir, f"export-{report_date}")
+    if np is not None and export_matches(export_path, log):
+        logging.info(f'Use exported records from {export_path}')
+        with profiler.stage("parsing"):
+            log_stats = load_export_stats(export_path, config["URL_NORMALIZE"])
+        profiler.done(log_stats)
+    else:
+        options = make_stats(config["EXACT"], config["URL_NORMALIZE"], config["ENGINE"]).options()
+        if config["CHECKPOINT_INTERVAL"]:
+            checkpoint = Checkpoint(
+                os.path.join(report_dir, f".report-{report_date}.checkpoint"),
+                log, options, config["CHECKPOINT_INTERVAL"])
+
+        log_stats = collect_stats(log, workers, config["EXACT"], checkpoint,
+                                  config["GZIP_BACKEND"], config["URL_NORMALIZE"],
+                                  config["ENGINE"], profiler)
+
+    if config["STATS_CACHE"]:
+        with profiler.stage("cache"):
+            cache_path = os.path.join(report_dir, config["STATS_CACHE"])
+            save_stats_cache(cache_path, log.date, log_stats)
+
+    with profiler.stage("report"):
+        stats = log_stats.report(err_perc=50, quantiles=config["QUANTILES"],
+                                 max_entries=config["REPORT_SIZE"])
+    if stats:
+        with profiler.stage("rendering"):
+            report_file = os.path.join(report_dir, f"report-{report_date}.html")
+            save_report(stats, config["REPORT_SIZE"], report_file, template,
+                        config["REPORT_PAGE_SIZE"])
+
+    if checkpoint:
+        checkpoint.remove()
+    return log.date
+
+
+def backfill_worker(log, config, report_dir, template):
+    try:
+        return process_log(log, config, report_dir, template)
+    except Exception as err:
+        logging.exception(f"Could not process {log.path}: {err}")
+
+
+def backfill(logs, config, report_dir):
+    # Каждый лог целиком обрабатывается в отдельном процессе. Число
+    # одновременно обрабатываемых логов ограничено числом процессов,
+    # а процесс перезапускается после каждого лога, чтобы память,
+    # занятая статистикой, возвращалась системе.
+    template = load_template()
+    tasks = [(log, config, report_dir, template) for log in logs]
+    with multiprocessing.Pool(processes=config["WORKERS"], maxtasksperchild=1) as pool:
+        for date in pool.starmap(backfill_worker, tasks, chunksize=1):
+            if date:
+                logging.info(f'Report for {date} is ready')
+
+
 def main(config):
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=argparse.FileType())
+    parser.add_argument("-w", "--workers", type=int)
+    parser.add_argument("-r", "--range", nargs=2, type=parse_date,
+                        metavar=("YYYYMMDD", "YYYYMMDD"))
+    parser.add_argument("-b", "--backfill", action="store_true")
+    parser.add_argument("-f", "--follow", action="store_true")
+    parser.add_argument("-e", "--export", action="store_true")
+    parser.add_argument("-p", "--profile", action="store_true")
 
-    new_config = parser.parse_args().config
+    args = parser.parse_args()
+    new_config = args.config
     if new_config:
         try:
             config = read_config(copy.deepcopy(config), new_config)
@@ -163,28 +1523,60 @@ def main(config):
             print("Cant parse config")
             raise err
 
+    if args.workers:
+        config = dict(config, WORKERS=args.workers)
+    if args.backfill:
+        config = dict(config, BACKFILL=True)
+    if args.profile:
+        config = dict(config, PROFILE=True)
+
     logging.basicConfig(filename=config["LOG_FILE"],
                         format="[%(asctime)s] %(levelname).1s %(message)s",
                         datefmt="%Y.%m.%d %H:%M:%S",
                         level=logging.DEBUG)
 
     try:
-        log = find_log(os.path.realpath(config["LOG_DIR"]))
+        report_dir = os.path.realpath(config["REPORT_DIR"])
+        if args.range:
+            build_range_report(config, report_dir, *args.range)
+            return
+
+        if args.follow:
+            follow(config, report_dir)
+            return
+
+        if config["BACKFILL"]:
+            logs = [log for log in find_logs(os.path.realpath(config["LOG_DIR"]))
+                    if not report_exists(report_dir, log.date)]
+            if not logs:
+                logging.info('There are no logs without reports')
+                return
+
+            logging.info(f'Build reports for {len(logs)} logs')
+            backfill(logs, config, report_dir)
+            return
+
+        profiler = Profiler(config["PROGRESS_INTERVAL"])
+        with profiler.stage("discovery"):
+            log = find_log(os.path.realpath(config["LOG_DIR"]))
+            exists = log and report_exists(report_dir, log.date)
         if not log:
             logging.info('Could not find any logs')
             return
 
-        report_dir = os.path.realpath(config["REPORT_DIR"])
-        if report_exists(report_dir, log.date):
+        if args.export:
+            export_path = os.path.join(report_dir, f"export-{log.date.strftime('%Y.%m.%d')}")
+            count = export_log(log, export_path, config["GZIP_BACKEND"])
+            logging.info(f'Exported {count} records to {export_path}')
+        elif exists:
             logging.info(f'Report for {log.date} exists')
         else:
-            stats = count_stats(parse_log(log), err_perc=50)
-            if stats:
-                report_date = log.date.strftime('%Y.%m.%d')
-                report_file = os.path.join(report_dir, f"report-{report_date}.html")
-                report_size = config["REPORT_SIZE"]
-                save_report(stats, report_size, report_file)
+            process_log(log, config, report_dir, workers=config["WORKERS"], profiler=profiler)
+            if config["PROFILE"]:
+                logging.info(f'Profile: {json.dumps(profiler.summary())}')
 
+    except KeyboardInterrupt:
+        pass
     except Exception as err:
         logging.exception(err)
 
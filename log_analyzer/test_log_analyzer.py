@@ -3,10 +3,25 @@
 
 
 import datetime
+import gzip
 from re import I
+import shutil
 import tempfile
 import unittest
 from log_analyzer import find_log, report_exists, parse_log, count_stats, read_config
+from log_analyzer import split_log, count_stats_parallel, QuantileSketch
+from log_analyzer import parse_line, parse_line_fast, parse_request, collect_stats
+from log_analyzer import LogStats, save_stats_cache, load_stats_cache, Checkpoint
+from log_analyzer import find_logs, backfill, config as default_config
+from log_analyzer import open_log, skip_bytes, GZIP_COMMANDS, UrlNormalizer
+from log_analyzer import LogTail, RollingStats, window_name
+from log_analyzer import parse_record, export_log, load_export, export_matches, np
+from log_analyzer import VectorStats, load_export_stats, save_report, Profiler
+import random
+import array
+import bisect
+import json
+import os
 from collections import namedtuple
 from os import path
 from pathlib import Path
@@ -14,6 +29,13 @@ from pathlib import Path
 
 testLogFileTuple = namedtuple("log", ["path", "is_gz"])
 
+TEST_LOG_LINES = [
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n',
+    '1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" "1498697422-32900793-4708-9752770" "-" 0.133\n',
+    '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 "-" "Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.199\n',
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.210\n',
+]
+
 
 class TestLogAnalyzer(unittest.TestCase):
     def setUp(self):
@@ -46,6 +68,17 @@ class TestLogAnalyzer(unittest.TestCase):
         self.assertEqual(log.date, datetime.date(2017, 5, 30))
         self.assertTrue(log.is_gz)
 
+    def test_find_logs(self):
+        Path(path.join(self.test_path, 'nginx-access-ui.log-20170630')).touch()
+        Path(path.join(self.test_path, 'nginx-access-ui.log-20170530.gz')).touch()
+        Path(path.join(self.test_path, 'nginx-access-ui.log-20177730')).touch()
+        Path(path.join(self.test_path, 'nginx-access-ui.log-20170601.bz2')).touch()
+
+        logs = find_logs(self.test_path)
+        self.assertListEqual([log.date for log in logs], [datetime.date(2017, 5, 30), datetime.date(2017, 6, 30)])
+        self.assertTrue(logs[0].is_gz)
+        self.assertFalse(logs[1].is_gz)
+
     def test_report_exists(self):
         Path(path.join(self.test_path, 'report-2017.01.02.html')).touch()
 
@@ -117,6 +150,463 @@ class TestLogAnalyzer(unittest.TestCase):
         stats = count_stats(log, err_perc=1)
         self.assertIsNone(stats)
 
+    def test_count_stats_quantiles(self):
+        log = [('', '', '', '', f'"GET /url/{i % 2} HTTP/1.1"', '', '', '', '', '', '', '', str(i / 100))
+               for i in range(1, 101)]
+
+        stats = count_stats(log, err_perc=50, quantiles=True)
+        self.assertEqual(stats['/url/1']['time_p50'], 0.49)
+        self.assertEqual(stats['/url/1']['time_p90'], 0.89)
+        self.assertEqual(stats['/url/1']['time_p99'], 0.99)
+        self.assertEqual(stats['/url/1']['time_med'], 0.5)
+        self.assertNotIn('time_p50', count_stats(log, err_perc=50)['/url/1'])
+
+    def test_report_top(self):
+        stats = LogStats()
+        for i in range(1000):
+            stats.add_request(f'/url/{i % 97}', (i * 31 % 101) / 100)
+
+        full = stats.report(err_perc=50)
+        expected = sorted(full.values(), key=lambda value: value["time_sum"], reverse=True)[:10]
+        top = stats.report(err_perc=50, max_entries=10)
+        self.assertListEqual(list(top.values()), expected)
+        self.assertEqual(len(stats.report(err_perc=50, max_entries=0)), 0)
+
+    def test_url_normalizer(self):
+        normalizer = UrlNormalizer(["query", "numbers", "hex"])
+        self.assertEqual(normalizer('/api/v2/banner/25019354'), '/api/v2/banner/{id}')
+        self.assertEqual(normalizer('/api/1/photogenic_banners/list/?server_name=WIN7RB4'),
+                         '/api/{id}/photogenic_banners/list/')
+        self.assertEqual(normalizer('/slot/dc7161be3/groups#top'), '/slot/{hex}/groups')
+        self.assertEqual(normalizer('/u/123e4567-e89b-12d3-a456-426614174000'), '/u/{hex}')
+        self.assertEqual(normalizer('/api/v2/deadbeef/facade'), '/api/v2/deadbeef/facade')
+        self.assertIs(normalizer('/banner/1'), normalizer('/banner/2'))
+
+        self.assertEqual(UrlNormalizer(["numbers"])('/banner/1?id=2'), '/banner/{id}?id=2')
+        self.assertEqual(UrlNormalizer(["query"])('/banner/1?id=2'), '/banner/1')
+        with self.assertRaises(ValueError):
+            UrlNormalizer(["path"])
+
+    def test_count_stats_normalize(self):
+        log = [('', '', '', '', '"GET /url/1 HTTP/1.1"', '', '', '', '', '', '', '', '0.1'),
+               ('', '', '', '', '"GET /url/2?a=1 HTTP/1.1"', '', '', '', '', '', '', '', '0.2'),
+               ('', '', '', '', '"GET /url/ HTTP/1.1"', '', '', '', '', '', '', '', '0.3')]
+
+        stats = count_stats(log, err_perc=50, normalize=["query", "numbers"])
+        self.assertListEqual(sorted(stats), ['/url/', '/url/{id}'])
+        self.assertEqual(stats['/url/{id}']['count'], 2)
+        self.assertEqual(stats['/url/{id}']['url'], '/url/{id}')
+
+        for is_gz in (False, True):
+            log = self.write_test_log(is_gz)
+            stats = collect_stats(log, 3, normalize=["numbers"]).report(err_perc=50)
+            self.assertEqual(stats['/api/v2/banner/{id}']['count'], 150)
+
+    def test_quantile_sketch(self):
+        values = [(i * 7919) % 100000 for i in range(100000)]
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+
+        self.assertFalse(sketch.is_exact())
+        self.assertLess(sum(len(items) for items in sketch.levels), 256 * len(sketch.levels))
+        for perc in (50, 90, 99):
+            self.assertAlmostEqual(sketch.quantile(perc), perc * 1000, delta=2000)
+
+        exact = QuantileSketch(size=None)
+        for value in values:
+            exact.add(value)
+        self.assertTrue(exact.is_exact())
+        self.assertEqual(exact.median(), 49999.5)
+
+    def test_quantile_sketch_merge(self):
+        left, right = QuantileSketch(), QuantileSketch()
+        for i in range(10000):
+            left.add(i)
+            right.add(10000 + i)
+        left.merge(right)
+
+        self.assertEqual(left.count, 20000)
+        self.assertAlmostEqual(left.median(), 10000, delta=400)
+
+    def test_quantile_sketch_skewed(self):
+        # На несимметричных данных сжатия не должны смещать оценку:
+        # доля значений не больше оценки близка к перцентилю.
+        rnd = random.Random(1)
+        values = [rnd.expovariate(5) for _ in range(100000)]
+        single, parts = QuantileSketch(), [QuantileSketch() for _ in range(4)]
+        for i, value in enumerate(values):
+            single.add(value)
+            parts[i % 4].add(value)
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+
+        values.sort()
+        for sketch in (single, merged):
+            for perc in (50, 90, 99):
+                rank = bisect.bisect_right(values, sketch.quantile(perc)) / len(values)
+                self.assertAlmostEqual(rank, perc / 100, delta=0.01)
+
+    def test_parse_request(self):
+        for line in TEST_LOG_LINES:
+            report = parse_line(line.rstrip("\n"))
+            expected = (report[4].split()[1], float(report[12]))
+            self.assertEqual(parse_line_fast(line.encode()), expected)
+            self.assertEqual(parse_line_fast(line.rstrip("\n").encode()), expected)
+            self.assertEqual(parse_request(line.encode()), expected)
+
+    def test_parse_request_fallback(self):
+        line = b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /url HTTP/1.1" - 0 "-" "-" "-" "-" "-" 0.199\n'
+        self.assertIsNone(parse_line_fast(line))
+        self.assertEqual(parse_request(line), ('/url', 0.199))
+
+        line = b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 19415 "-" "Slotovod" "-" "-" "-" 0.199\n'
+        self.assertIsNone(parse_request(line))
+        line = b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /url HTTP/1.1" 200 0 "-" "-" "-" "-" "-" -\n'
+        self.assertIsNone(parse_request(line))
+
+    def test_parse_request_utf8(self):
+        line = '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /поиск HTTP/1.1" 200 0 "-" "-" "-" "-" "-" 0.199\n'
+        self.assertEqual(parse_request(line.encode()), ('/поиск', 0.199))
+        self.assertEqual(parse_request(b'\xff\xfe' + line.encode()), ('/поиск', 0.199))
+
+    def test_collect_stats(self):
+        log = self.write_test_log(is_gz=True)
+        expected = count_stats(parse_log(log), err_perc=50)
+        self.assertEqual(collect_stats(log).report(err_perc=50), expected)
+
+    def test_quantile_sketch_bytes(self):
+        sketch = QuantileSketch()
+        for i in range(1000):
+            sketch.add(i / 7)
+
+        loaded = QuantileSketch.from_bytes(sketch.to_bytes(), sketch.count)
+        self.assertEqual(loaded.size, sketch.size)
+        self.assertEqual(loaded.levels, sketch.levels)
+        self.assertEqual(loaded.median(), sketch.median())
+
+    def test_stats_cache(self):
+        cache_path = path.join(self.test_path, 'stats.sqlite3')
+        first, second = LogStats(), LogStats()
+        for url, time in [('/url/1', 0.1), ('/url/2', 0.2), ('/url/1', 0.4)]:
+            first.add_request(url, time)
+        for url, time in [('/url/1', 0.3), ('/url/3', 0.5)]:
+            second.add_request(url, time)
+        second.err_count = 1
+
+        save_stats_cache(cache_path, datetime.date(2017, 6, 29), first)
+        save_stats_cache(cache_path, datetime.date(2017, 6, 30), second)
+        save_stats_cache(cache_path, datetime.date(2017, 7, 1), second)
+
+        stats, dates = load_stats_cache(cache_path, datetime.date(2017, 6, 29), datetime.date(2017, 6, 30))
+        self.assertListEqual(dates, [datetime.date(2017, 6, 29), datetime.date(2017, 6, 30)])
+
+        expected = LogStats()
+        expected.merge(first)
+        expected.merge(second)
+        self.assertEqual(stats.report(err_perc=50), expected.report(err_perc=50))
+
+        stats, dates = load_stats_cache(cache_path, datetime.date(2017, 5, 1), datetime.date(2017, 5, 30))
+        self.assertListEqual(dates, [])
+
+    def test_checkpoint_resume(self):
+        for is_gz, workers in ((False, 1), (True, 1), (False, 3), (True, 3)):
+            log = self.write_test_log(is_gz)
+            expected = collect_stats(log).report(err_perc=50)
+
+            checkpoint_path = path.join(self.test_path, 'checkpoint')
+            checkpoint = Checkpoint(checkpoint_path, log, LogStats().options(), interval=0)
+            partial = LogStats()
+            partial.add_lines(line.encode() for line in TEST_LOG_LINES * 3)
+            offset = sum(len(line) for line in TEST_LOG_LINES * 3)
+            checkpoint.save(partial, offset)
+
+            checkpoint = Checkpoint(checkpoint_path, log, LogStats().options(), interval=0)
+            stats = collect_stats(log, workers, checkpoint=checkpoint)
+            self.assertEqual(stats.report(err_perc=50), expected)
+
+            checkpoint.remove()
+            self.assertFalse(path.exists(checkpoint_path))
+
+    def test_checkpoint_other_log(self):
+        log = self.write_test_log(is_gz=False)
+        checkpoint_path = path.join(self.test_path, 'checkpoint')
+        Checkpoint(checkpoint_path, log, LogStats().options(), interval=0).save(LogStats(), 100)
+
+        log = self.write_test_log(is_gz=False, repeat=51)
+        self.assertEqual(Checkpoint(checkpoint_path, log, LogStats().options(), interval=0).load(), (None, 0))
+
+    def test_profiler(self):
+        for is_gz, workers in ((False, 1), (True, 3)):
+            log = self.write_test_log(is_gz)
+            profiler = Profiler()
+            stats = collect_stats(log, workers, profiler=profiler)
+            summary = profiler.summary()
+
+            self.assertEqual(summary["lines"], len(TEST_LOG_LINES) * 50)
+            self.assertEqual(summary["bytes"], sum(len(line) for line in TEST_LOG_LINES) * 50)
+            self.assertEqual(summary["err_perc"], 100 * stats.err_count / summary["lines"])
+            self.assertIn("waiting" if workers > 1 else "parsing", summary["stages"])
+            self.assertIn("decompression", summary["stages"])
+            self.assertGreater(summary["peak_rss_mb"], 0)
+
+        profiler = Profiler(progress_interval=1e-9)
+        with self.assertLogs(level='INFO') as logs:
+            collect_stats(log, profiler=profiler)
+        self.assertIn(f"{len(TEST_LOG_LINES) * 50} lines", logs.output[-1])
+
+    def test_backfill(self):
+        for date in ('20170529', '20170530'):
+            with open(path.join(self.test_path, f'nginx-access-ui.log-{date}'), "w") as f:
+                f.writelines(TEST_LOG_LINES)
+
+        config = dict(default_config, WORKERS=2, LOG_FILE=None)
+        backfill(find_logs(self.test_path), config, self.test_path)
+
+        self.assertTrue(report_exists(self.test_path, datetime.date(2017, 5, 29)))
+        self.assertTrue(report_exists(self.test_path, datetime.date(2017, 5, 30)))
+        _, dates = load_stats_cache(path.join(self.test_path, config["STATS_CACHE"]),
+                                    datetime.date(2017, 5, 1), datetime.date(2017, 5, 31))
+        self.assertListEqual(dates, [datetime.date(2017, 5, 29), datetime.date(2017, 5, 30)])
+
+    def test_open_log_backends(self):
+        log_path = path.join(self.test_path, 'nginx-access-ui.log-20170530.gz')
+        data = "".join(TEST_LOG_LINES * 1000).encode()
+        with open(log_path, "wb") as f:
+            f.write(gzip.compress(data[:50000]))
+            f.write(gzip.compress(data[50000:]))
+
+        log = testLogFileTuple(log_path, True)
+        backends = ["gzip", "zlib"] + [backend for backend, command in GZIP_COMMANDS.items()
+                                       if shutil.which(command[0])]
+        for backend in backends:
+            with open_log(log, backend) as f:
+                self.assertEqual(f.read(), data, backend)
+            with open_log(log, backend) as f:
+                skip_bytes(f, 70000)
+                self.assertEqual(f.readline(), data[70000:data.index(b"\n", 70000) + 1], backend)
+
+    def test_open_log_truncated(self):
+        log_path = path.join(self.test_path, 'nginx-access-ui.log-20170530.gz')
+        data = gzip.compress("".join(TEST_LOG_LINES * 1000).encode())
+        with open(log_path, "wb") as f:
+            f.write(data[:len(data) // 2])
+
+        log = testLogFileTuple(log_path, True)
+        backends = ["gzip", "zlib"] + [backend for backend, command in GZIP_COMMANDS.items()
+                                       if shutil.which(command[0])]
+        for backend in backends:
+            with self.assertRaises((EOFError, OSError), msg=backend):
+                with open_log(log, backend) as f:
+                    while f.read(65536):
+                        pass
+
+    def test_parse_record(self):
+        self.assertEqual(parse_record(TEST_LOG_LINES[0].encode()),
+                         (1498697422, '/api/v2/banner/25019354', 200, 927, 0.39))
+        line = b'1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /url HTTP/1.1" - - "-" "-" "-" "-" "-" 0.199\n'
+        self.assertEqual(parse_record(line), (1498697422, '/url', 0, 0, 0.199))
+        self.assertIsNone(parse_record(b'garbage\n'))
+
+    def test_export_log(self):
+        log = self.write_test_log(is_gz=True, repeat=2)
+        with open(log.path, "ab") as f:
+            f.write(gzip.compress(b"garbage\n"))
+        export_path = path.join(self.test_path, 'export')
+        self.assertEqual(export_log(log, export_path), 8)
+
+        with open(path.join(export_path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.assertEqual(meta['count'], 8)
+        self.assertEqual(meta['errors'], 1)
+        with open(path.join(export_path, 'urls.json')) as f:
+            urls = json.load(f)
+        self.assertEqual(len(urls), 3)
+
+        columns = {}
+        for name, typecode in (('url', 'i'), ('status', 'h'), ('time', 'd')):
+            columns[name] = array.array(typecode)
+            with open(path.join(export_path, f'{name}.bin'), 'rb') as f:
+                columns[name].frombytes(f.read())
+        self.assertListEqual([urls[i] for i in columns['url'][:4]],
+                             [line.split()[6] for line in TEST_LOG_LINES])
+        self.assertListEqual(list(columns['status']), [200] * 8)
+        self.assertListEqual(list(columns['time'][:4]), [0.39, 0.133, 0.199, 0.21])
+
+    def test_export_matches(self):
+        log = self.write_test_log(is_gz=True)
+        export_path = path.join(self.test_path, 'export')
+        self.assertFalse(export_matches(export_path, log))
+        export_log(log, export_path)
+        self.assertTrue(export_matches(export_path, log))
+
+        # Лог изменился после выгрузки.
+        with open(log.path, "ab") as f:
+            f.write(gzip.compress(TEST_LOG_LINES[0].encode()))
+        self.assertFalse(export_matches(export_path, log))
+
+        # Прерванная выгрузка не оставляет meta.json.
+        with open(log.path, "r+b") as f:
+            f.truncate(os.path.getsize(log.path) - 10)
+        with self.assertRaises(EOFError):
+            export_log(log, export_path, backend="zlib")
+        self.assertFalse(path.exists(path.join(export_path, 'meta.json')))
+        self.assertFalse(export_matches(export_path, log))
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_load_export(self):
+        log = self.write_test_log(is_gz=False, repeat=2)
+        export_path = path.join(self.test_path, 'export')
+        export_log(log, export_path)
+
+        columns, urls, meta = load_export(export_path)
+        self.assertEqual(len(columns['ts']), 8)
+        self.assertEqual(urls[columns['url'][1]], '/api/1/photogenic_banners/list/?server_name=WIN7RB4')
+        self.assertAlmostEqual(float(columns['time'].sum()), 1.864)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_vector_stats(self):
+        rnd = random.Random(1)
+        lines = [line.encode() for line in TEST_LOG_LINES]
+        for i in range(5000):
+            lines.append(TEST_LOG_LINES[0].replace('25019354', str(rnd.randrange(300)))
+                         .replace('0.390', f'{rnd.expovariate(3):.3f}').encode())
+        lines.append(b'garbage\n')
+
+        expected = LogStats(exact=True)
+        expected.add_lines(lines)
+        vector = VectorStats()
+        vector.add_lines(lines[:2000])
+        vector.add_lines(lines[2000:])
+        self.assertEqual(vector.requests_time, expected.requests_time)
+
+        for max_entries in (None, 0, 10, 1000):
+            for quantiles in (False, True):
+                self.assertEqual(vector.report(50, quantiles, max_entries),
+                                 expected.report(50, quantiles, max_entries))
+
+        merged = VectorStats()
+        merged.merge(vector)
+        merged.merge(VectorStats())
+        self.assertEqual(merged.report(50, max_entries=10), expected.report(50, max_entries=10))
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_load_export_stats(self):
+        log = self.write_test_log(is_gz=False)
+        export_path = path.join(self.test_path, 'export')
+        export_log(log, export_path)
+
+        expected = collect_stats(log, exact=True, normalize=['numbers']).report(50)
+        stats = load_export_stats(export_path, normalize=['numbers'])
+        self.assertEqual(stats.report(50), expected)
+
+    def read_report(self, report_path):
+        with open(report_path) as f:
+            report = f.read()
+        table = report.split("var table = ", 1)[1].split(";\n", 1)[0]
+        pages = report.split("var pages = ", 1)[1].split(";\n", 1)[0]
+        return json.loads(table), json.loads(pages)
+
+    def test_save_report(self):
+        stats = LogStats()
+        for i in range(10):
+            stats.add_request(f'/url/{i}</script>', i / 10)
+        stats = stats.report(err_perc=50)
+        report_path = path.join(self.test_path, 'report-2017.06.30.html')
+
+        save_report(stats, 5, report_path)
+        with open(report_path) as f:
+            self.assertNotIn('</script>"', f.read())
+        table, pages = self.read_report(report_path)
+        self.assertListEqual([row['url'] for row in table], [f'/url/{i}</script>' for i in range(9, 4, -1)])
+        self.assertIsNone(pages)
+
+        save_report(stats, 9, report_path, page_size=4)
+        table, pages = self.read_report(report_path)
+        self.assertEqual(len(table), 4)
+        self.assertListEqual(pages, ['report-2017.06.30.pages/1.json', 'report-2017.06.30.pages/2.json'])
+        for page in pages:
+            with open(path.join(self.test_path, page)) as f:
+                table += json.load(f)
+        self.assertListEqual([row['url'] for row in table], [f'/url/{i}</script>' for i in range(9, 0, -1)])
+
+    def test_log_tail(self):
+        log_path = path.join(self.test_path, 'nginx-access-ui.log')
+        with open(log_path, "w") as f:
+            f.write(TEST_LOG_LINES[0])
+
+        tail = LogTail(log_path)
+        self.assertListEqual(tail.read_lines(), [])
+        with open(log_path, "a") as f:
+            f.write(TEST_LOG_LINES[1])
+            f.write(TEST_LOG_LINES[2][:10])
+        self.assertListEqual(tail.read_lines(), [TEST_LOG_LINES[1].encode()])
+        with open(log_path, "a") as f:
+            f.write(TEST_LOG_LINES[2][10:])
+        self.assertListEqual(tail.read_lines(), [TEST_LOG_LINES[2].encode()])
+
+        os.rename(log_path, log_path + '-20170630')
+        with open(log_path + '-20170630', "a") as f:
+            f.write(TEST_LOG_LINES[3])
+        with open(log_path, "w") as f:
+            f.write(TEST_LOG_LINES[0])
+        self.assertListEqual(tail.read_lines(), [TEST_LOG_LINES[3].encode()])
+        self.assertListEqual(tail.read_lines(), [])
+        self.assertListEqual(tail.read_lines(), [TEST_LOG_LINES[0].encode()])
+
+        with open(log_path, "w") as f:
+            f.write(TEST_LOG_LINES[1][:5])
+        self.assertListEqual(tail.read_lines(), [])
+        with open(log_path, "w") as f:
+            f.write(TEST_LOG_LINES[1])
+        self.assertListEqual(tail.read_lines(), [TEST_LOG_LINES[1].encode()])
+        tail.close()
+
+    def test_rolling_stats(self):
+        window = RollingStats(60, LogStats().options())
+        window.add(('/url/1', 0.1), now=0)
+        window.add(('/url/1', 0.3), now=30)
+        window.add(None, now=30)
+        window.add(('/url/2', 0.2), now=65)
+
+        stats = window.stats(now=65)
+        self.assertEqual(stats.urls['/url/1']['count'], 1)
+        self.assertEqual(stats.urls['/url/2']['count'], 1)
+        self.assertEqual(stats.err_count, 1)
+        self.assertEqual(window.stats(now=65).urls['/url/1']['count'], 1)
+
+        self.assertEqual(len(window.stats(now=200).urls), 0)
+        self.assertEqual(len(window.buckets), 0)
+        self.assertListEqual([window_name(w) for w in (60, 300, 3600, 45)], ['1m', '5m', '1h', '45s'])
+
+    def write_test_log(self, is_gz, repeat=50):
+        log_path = path.join(self.test_path, 'nginx-access-ui.log-20170530')
+        opener = open if not is_gz else gzip.open
+        with opener(log_path, "wt") as f:
+            for _ in range(repeat):
+                f.writelines(TEST_LOG_LINES)
+        return testLogFileTuple(log_path, is_gz)
+
+    def test_split_log(self):
+        log = self.write_test_log(is_gz=False)
+        chunks = split_log(log.path, 7)
+
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], path.getsize(log.path))
+        with open(log.path, "rb") as f:
+            data = f.read()
+        for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1:start], b"\n")
+
+    def test_count_stats_parallel(self):
+        for is_gz in (False, True):
+            log = self.write_test_log(is_gz)
+            expected = count_stats(parse_log(log), err_perc=50)
+            stats = count_stats_parallel(log, 3, err_perc=50)
+            self.assertEqual(stats, expected)
+
 
 if __name__ == '__main__':
     unittest.main()